@@ -0,0 +1,149 @@
+import os
+import json
+import time
+from openai import OpenAI
+import performance_test as pt
+from nupack_cache import ComplexAnalysisCache, NUPACK_CACHE_PATH
+
+# Evaluation through the OpenAI Batch API. All first attempts for a validation set are written to a
+# JSONL request file and submitted as one batch job; samples whose answers fail validation are
+# resubmitted as further batch rounds until they have used up max_tries. Expert pipelines need
+# the answer of one model before they can ask the next, so only single-model conditions are supported.
+BATCH_DIR = "batch_requests"
+BATCH_CONDITIONS = {
+    "reverse_complement": ["naive", "CoT"],
+    "secondary_structure": ["naive", "rev2CoT", "seq2CoT", "+rev_comp+CoT"],
+    "minimum_free_energy": ["naive", "rev2CoT", "+rev_comp+CoT", "+rev_comp+dotpar"],
+    "sequence_design": ["naive", "CoTseq2", "CoTrev2+rev_comp"],
+}
+
+
+def batch_sample(experiment, condition, sample):
+    """Return the result dict, request message and output parser for one validation sample."""
+    if experiment == "reverse_complement":
+        seq1, seq2, mfe, prob_string, dotpar = sample
+        return pt.reverse_complement_result(sample), pt.reverse_complement_message(seq2), lambda out_string: pt.parse_reverse_complement(out_string,condition,seq2)
+    elif experiment == "secondary_structure":
+        seq1, seq2, mfe, prob_string, dotpar = sample
+        message = pt.secondary_structure_message(condition,seq1,seq2,pt.reverse_complement(seq2))
+        return pt.secondary_structure_result(sample), message, lambda out_string: pt.parse_secondary_structure(out_string,condition,seq1,seq2)
+    elif experiment == "minimum_free_energy":
+        seq1, seq2, mfe, prob_string, dotpar = sample
+        message = pt.mfe_message(condition,seq1,seq2,pt.reverse_complement(seq2),dotpar)
+        return pt.mfe_result(sample), message, lambda out_string: pt.parse_mfe(out_string,condition)
+    elif experiment == "sequence_design":
+        dotpar, _, _ = sample
+        return {"structure": dotpar}, pt.sequence_message(dotpar), lambda out_string: pt.parse_sequence(out_string,condition,dotpar)
+
+
+def finish_sample(experiment, condition, res_dic, ans_string, nupack_cache):
+    if experiment == "reverse_complement":
+        res_dic["model"] = ans_string
+    elif experiment == "secondary_structure":
+        res_dic["model_structure"] = ans_string
+    elif experiment == "minimum_free_energy":
+        res_dic["model_MFE"] = ans_string
+    elif experiment == "sequence_design":
+        if ans_string == "2":
+            model_seq1 = model_seq2 = model_dotpar = "2"
+        else:
+            model_seq1 = ans_string[0]
+            model_seq2 = pt.reverse_complement(ans_string[1]) if condition == "CoTrev2+rev_comp" else ans_string[1]
+            model_dotpar = pt.structure_from_strands(model_seq1,model_seq2,None,cache=nupack_cache)
+        res_dic.update({"model_structure": model_dotpar, "model_seq1": model_seq1, "model_seq2": model_seq2})
+    return res_dic
+
+
+def write_batch_requests(filename, requests, modelid):
+    with open(filename, 'w') as f:
+        for custom_id, message in requests:
+            request = {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                       "body": {"model": modelid, "messages": message}}
+            f.write(json.dumps(request) + '\n')
+
+
+def submit_batch(client, filename):
+    batch_file = client.files.create(file=open(filename, "rb"), purpose="batch")
+    batch = client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+    print(f"Submitted batch {batch.id} ({filename})")
+    return batch.id
+
+
+def wait_for_batch(client, batch_id, poll_interval):
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        print(f"Batch status: {batch.status}")
+        if batch.status == "completed":
+            return batch
+        if batch.status in ("failed", "expired", "cancelled"):
+            raise RuntimeError(f"batch {batch_id} ended with status {batch.status}")
+        time.sleep(poll_interval)
+
+
+def read_batch_output(client, batch):
+    """Map each custom_id to its response text, or None where the request itself errored."""
+    outputs = {}
+    if batch.output_file_id is not None:
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response")
+            if response is not None and response["status_code"] == 200:
+                outputs[entry["custom_id"]] = str(response["body"]["choices"][0]["message"]["content"])
+            else:
+                outputs[entry["custom_id"]] = None
+    return outputs
+
+
+def analyze_model_batch(experiment, condition, train_size, max_tries, modelid, client=None, poll_interval=60, max_rounds=None):
+    if condition not in BATCH_CONDITIONS[experiment]:
+        raise ValueError(f"batch mode does not support the {experiment} condition {condition}")
+    if client is None:
+        client = OpenAI()
+    if max_rounds is None:
+        max_rounds = 2*max_tries  # rounds lost to request errors do not count as tries
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    nupack_cache = ComplexAnalysisCache(NUPACK_CACHE_PATH, material='DNA', celsius=20) if experiment == "sequence_design" else None
+
+    val_set = pt.load_validation_set(experiment)
+    samples = [batch_sample(experiment,condition,sample) for sample in val_set]
+    responses = [None]*len(val_set)
+    bad_outputs = [0]*len(val_set)
+    pending = list(range(len(val_set)))
+    for batch_round in range(max_rounds):
+        if not pending:
+            break
+        filename = f"{BATCH_DIR}/{experiment}_{condition}_test_size_{train_size}_round_{batch_round}.jsonl"
+        write_batch_requests(filename, [(f"sample-{indx}", samples[indx][1]) for indx in pending], modelid)
+        batch = wait_for_batch(client, submit_batch(client, filename), poll_interval)
+        outputs = read_batch_output(client, batch)
+
+        still_pending = []
+        for indx in pending:
+            res_dic, _, validate = samples[indx]
+            out_string = outputs.get(f"sample-{indx}")
+            if out_string is None: # request errored, retry without counting it as a try
+                still_pending.append(indx)
+                continue
+            ans_string = validate(out_string)
+            if ans_string is not None:
+                responses[indx] = finish_sample(experiment,condition,res_dic,ans_string,nupack_cache)
+                continue
+            bad_outputs[indx] += 1
+            if bad_outputs[indx] == max_tries:
+                responses[indx] = finish_sample(experiment,condition,res_dic,"2",nupack_cache)
+            else:
+                still_pending.append(indx)
+        print(f"Batch round {batch_round}: {len(pending)-len(still_pending)} samples finished, {len(still_pending)} to retry")
+        pending = still_pending
+
+    for indx in pending:
+        responses[indx] = finish_sample(experiment,condition,samples[indx][0],"2",nupack_cache)
+    if nupack_cache is not None:
+        nupack_cache.close()
+
+    with open(pt.results_filename(experiment,condition,max_tries,train_size), 'w') as f:
+        for item in responses:
+            f.write(json.dumps(item) + '\n')
+    return responses
@@ -0,0 +1,194 @@
+import os
+import re
+import sys
+import time
+from functools import cached_property
+from json.encoder import encode_basestring_ascii as json_string
+from dna_kernels import reverse_complement, windows
+from columnar_dataset import load_dataset
+
+# Builds the fine-tuning JSONL files of any number of conditions and train sizes in one pass over
+# the training set. Train sizes are prefixes of the training set, so every example is formatted
+# once per condition and the line is written to each train-size file that contains it. Fields
+# several conditions share (the reverse complement and the chain-of-thought steps) are computed
+# once per example. The output is byte for byte what json.dumps gives for the message dicts.
+TRAIN_SIZES = [200, 500, 1400, 3700, 10000]
+
+REVERSE_COMPLEMENT_SYSTEM = "You are a DNA analyzer. Please return the reverse complement of the following sequence."
+STRUCTURE_SYSTEM = "You are a DNA analyzer. Please analyze the following DNA sequence pair and produce the secondary structure in parens-dot-plus notation."
+STRUCTURE_REV_COMP_SYSTEM = "You are a DNA analyzer. Please analyze the following DNA sequence pair to produce the secondary structure in parens-dot-plus notation."
+MFE_SYSTEM = "You are a DNA analyzer. Please analyze the following DNA sequence pair and determine the corresponding minimum free energy in kcal/mol."
+MFE_DOTPAR_SYSTEM = "You are a DNA analyzer. Please analyze the following DNA sequence pair and secondary structure to determine the corresponding minimum free energy in kcal/mol."
+DESIGN_SYSTEM = "You are a DNA designer. Please design a pair of DNA sequences that will form the following secondary structure."
+
+
+class SequenceExample:
+    """A sequence training example, [seq1, seq2, mfe, prob_string, dotpar], with its derived fields computed on first use."""
+
+    def __init__(self, sample):
+        self.seq1, self.seq2, self.mfe, self.prob_string, self.dotpar = sample
+
+    @cached_property
+    def rev2(self):
+        return reverse_complement(self.seq2)
+
+    @cached_property
+    def rev_comp_steps(self):
+        seq2, rev2 = self.seq2, self.rev2
+        n = len(seq2)
+        return ' '.join([f"{seq2[:n-indx]},{seq2[-(indx+1)]}:{rev2[:indx+1]}" for indx in range(len(rev2))])
+
+    @cached_property
+    def pair_steps(self):
+        """Steps over the windows of seq1 and rev2, shared by the structure and MFE chain-of-thought conditions."""
+        dotpar = self.dotpar
+        return ' '.join([f"[{window1},{window2}]:{dotpar[:indx+1]}"
+                         for indx, (window1, window2) in enumerate(zip(windows(self.seq1), windows(self.rev2)))])
+
+    @cached_property
+    def seq2_steps(self):
+        dotpar = self.dotpar
+        return ' '.join([f"[{window1},{window2}]:{dotpar[:indx+1]}"
+                         for indx, (window1, window2) in enumerate(zip(windows(self.seq1), windows(self.seq2[::-1])))])
+
+
+class StructureExample:
+    """A sequence design training example, [dotpar, seq1, seq2]."""
+
+    def __init__(self, sample):
+        self.dotpar, self.seq1, self.seq2 = sample
+
+    @cached_property
+    def rev2(self):
+        return reverse_complement(self.seq2)
+
+    @cached_property
+    def design_steps(self):
+        seq1, rev2 = self.seq1, self.rev2
+        return ' '.join([f"[{window}]:[{seq1[:indx+1]},{rev2[:indx+1]}]" for indx, window in enumerate(windows(self.dotpar[:len(seq1)]))])
+
+
+# (system message, example -> (user message, assistant message)) of every condition
+CONDITIONS = {
+    "reverse_complement": {
+        "naive": (REVERSE_COMPLEMENT_SYSTEM, lambda ex: (ex.seq2, ex.rev2)),
+        "CoT": (REVERSE_COMPLEMENT_SYSTEM, lambda ex: (ex.seq2, f"{ex.rev_comp_steps} ans:{ex.rev2}")),
+    },
+    "secondary_structure": {
+        "naive": (STRUCTURE_SYSTEM, lambda ex: (f"{ex.seq1} {ex.seq2}", ex.dotpar)),
+        "rev2CoT": (STRUCTURE_SYSTEM, lambda ex: (f"{ex.seq1} {ex.seq2}", f"{ex.rev2} {ex.pair_steps} ans:{ex.dotpar}")),
+        "seq2CoT": (STRUCTURE_SYSTEM, lambda ex: (f"{ex.seq1} {ex.seq2}", f"{ex.seq2_steps} ans:{ex.dotpar}")),
+        "+rev_comp+CoT": (STRUCTURE_REV_COMP_SYSTEM, lambda ex: (f"{ex.seq1} {ex.rev2}", f"{ex.pair_steps} ans:{ex.dotpar}")),
+    },
+    "minimum_free_energy": {
+        "naive": (MFE_SYSTEM, lambda ex: (f"{ex.seq1} {ex.seq2}", f"{ex.mfe}")),
+        "rev2CoT": (MFE_SYSTEM, lambda ex: (f"{ex.seq1} {ex.seq2}", f"{ex.rev2} {ex.pair_steps} ans:{ex.mfe}")),
+        "+rev_comp+CoT": (MFE_SYSTEM, lambda ex: (f"{ex.seq1} {ex.rev2}", f"{ex.pair_steps} ans:{ex.mfe}")),
+        "+rev_comp+dotpar": (MFE_DOTPAR_SYSTEM, lambda ex: (f"{ex.seq1} {ex.rev2} {ex.dotpar}", f"{ex.mfe}")),
+    },
+    "sequence_design": {
+        "naive": (DESIGN_SYSTEM, lambda ex: (ex.dotpar, f"{ex.seq1} {ex.seq2}")),
+        "CoTrev2+rev_comp": (DESIGN_SYSTEM, lambda ex: (ex.dotpar, f"{ex.design_steps} ans:{ex.seq1} {ex.rev2}")),
+        "CoTseq2": (DESIGN_SYSTEM, lambda ex: (ex.dotpar, f"{ex.design_steps} ans:{ex.seq1} {ex.seq2}")),
+    },
+}
+
+
+def line_formatter(experiment, condition):
+    """Return a function turning an example into its JSONL line for the given condition."""
+    if condition not in CONDITIONS.get(experiment, {}):
+        raise ValueError(f"unknown {experiment} condition {condition}")
+    system, messages = CONDITIONS[experiment][condition]
+    # the constant parts of json.dumps({"messages": [...]}) are encoded once per condition
+    head = '{"messages": [{"role": "system", "content": ' + json_string(system) + '}, {"role": "user", "content": '
+    middle = '}, {"role": "assistant", "content": '
+    tail = '}]}\n'
+
+    def format_line(example):
+        user, assistant = messages(example)
+        return head + json_string(user) + middle + json_string(assistant) + tail
+    return format_line
+
+
+def fine_tune_filename(experiment, condition, train_size, out_dir="fine_tune_sets"):
+    return f"{out_dir}/{experiment}_{condition}_train_size_{train_size}.jsonl"
+
+
+def write_examples(experiment, samples, outputs):
+    """Write every example to the files of each condition whose train size includes it.
+
+    outputs is a list of (condition, [(train_size, file), ...]) with train sizes in increasing order.
+    """
+    example_class = StructureExample if experiment == "sequence_design" else SequenceExample
+    open_outputs = [(line_formatter(experiment, condition), list(files)) for condition, files in outputs]
+    for indx, sample in enumerate(samples):
+        open_outputs = [(format_line, files) for format_line, files in open_outputs if files]
+        if not open_outputs:
+            break
+        example = example_class(sample)
+        for format_line, files in open_outputs:
+            line = format_line(example)
+            for _, f in files:
+                f.write(line)
+            # a file is complete once its train size is reached
+            while files and files[0][0] == indx + 1:
+                files.pop(0)[1].close()
+    for _, files in open_outputs:
+        if files:
+            raise ValueError(f"the {experiment} training set has only {len(samples)} examples, fewer than train size {files[0][0]}")
+
+
+def build_fine_tune_sets(requests, out_dir="fine_tune_sets"):
+    """Write the fine-tuning files of every (experiment, condition, train_sizes) in requests and return their names.
+
+    Each training set is read once and every file built from it is written in the same pass.
+    """
+    by_experiment = {}
+    for experiment, condition, train_sizes in requests:
+        line_formatter(experiment, condition)  # unknown conditions fail before any file is opened
+        sizes = by_experiment.setdefault(experiment, {}).setdefault(condition, set())
+        sizes.update(train_sizes)
+
+    os.makedirs(out_dir, exist_ok=True)
+    filenames = []
+    for experiment, conditions in by_experiment.items():
+        samples = load_dataset("structure_train_set" if experiment == "sequence_design" else "sequence_train_set")
+        outputs = []
+        for condition, sizes in conditions.items():
+            files = []
+            for train_size in sorted(sizes):
+                filename = fine_tune_filename(experiment, condition, train_size, out_dir)
+                files.append((train_size, open(filename, 'w', buffering=1 << 20)))
+                filenames.append(filename)
+            outputs.append((condition, files))
+        try:
+            write_examples(experiment, samples, outputs)
+        finally:
+            for _, files in outputs:
+                for _, f in files:
+                    f.close()
+    return filenames
+
+
+def write_jsonl(experiment, condition, samples, output_filename):
+    """Write the fine-tuning file of one condition for the given examples."""
+    with open(output_filename, 'w', buffering=1 << 20) as f:
+        write_examples(experiment, samples, [(condition, [(len(samples), f)])])
+
+
+def existing_requests(out_dir="fine_tune_sets"):
+    """(experiment, condition, [train sizes]) for every file in out_dir, to regenerate the whole tree."""
+    requests = {}
+    for fn in os.listdir(out_dir):
+        match = re.fullmatch(r'(reverse_complement|secondary_structure|minimum_free_energy|sequence_design)_(.+)_train_size_(\d+)\.jsonl', fn)
+        if match:
+            requests.setdefault((match.group(1), match.group(2)), []).append(int(match.group(3)))
+    return [(experiment, condition, sizes) for (experiment, condition), sizes in sorted(requests.items())]
+
+
+if __name__ == '__main__':
+    # python build_fine_tune_sets.py [output directory]: rebuild every file in fine_tune_sets/
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else "fine_tune_sets"
+    t = time.time()
+    filenames = build_fine_tune_sets(existing_requests(), out_dir=out_dir)
+    print(f"wrote {len(filenames)} files in {time.time()-t:.2f} s")
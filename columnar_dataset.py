@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+from collections.abc import Sequence
+import numpy as np
+from dna_kernels import pad_rows
+
+# Compact, memory-mapped storage for the training and validation sets. A .col file holds one
+# column per field of the JSON tuples, each a fixed-width array with a row per example:
+# sequences and dot-paren structures packed at 2 bits per symbol, pair-probability strings at
+# 1 bit per symbol (each with a length column) and MFEs as float32. Opening a file reads only
+# its header; rows are decoded when they are used, and iterating decodes them in vectorized
+# chunks. Rows unpack like the JSON tuples, so code written for json.load works unchanged.
+#
+# Layout: MAGIC, the header length as 8 little-endian bytes, the JSON header, then the columns,
+# each starting at a multiple of ALIGNMENT from the start of the file.
+MAGIC = b"DNACOL1\n"
+ALIGNMENT = 64
+ITER_CHUNK = 4096  # rows decoded at once when iterating
+SCHEMAS = {
+    # kind: (field name, encoding, alphabet) in tuple order
+    "sequence": [("seq1", "packed", "ACGT"), ("seq2", "packed", "ACGT"), ("mfe", "float", None),
+                 ("prob_string", "packed", "01"), ("dotpar", "packed", ".()+")],
+    "structure": [("dotpar", "packed", ".()+"), ("seq1", "packed", "ACGT"), ("seq2", "packed", "ACGT")],
+}
+
+
+def symbol_bits(alphabet):
+    return 1 if len(alphabet) <= 2 else 2 if len(alphabet) <= 4 else 8
+
+
+def unpack_table(alphabet):
+    """(256, symbols per byte) array of the characters each packed byte stands for."""
+    bits = symbol_bits(alphabet)
+    per_byte = 8 // bits
+    letters = np.frombuffer(alphabet.encode('ascii').ljust(2**bits, b'?'), dtype=np.uint8)
+    shifts = 8 - bits*np.arange(1, per_byte + 1)
+    codes = (np.arange(256)[:, None] >> shifts) & (2**bits - 1)
+    return letters[codes]
+
+
+def pack_strings(strings, alphabet):
+    """Pack strings over alphabet into a (n, bytes per row) uint8 array, and their lengths."""
+    bits = symbol_bits(alphabet)
+    per_byte = 8 // bits
+    lookup = np.full(256, 255, dtype=np.uint8)
+    lookup[np.frombuffer(alphabet.encode('ascii'), dtype=np.uint8)] = np.arange(len(alphabet))
+    chars, lengths = pad_rows(strings, alphabet[0])
+    codes = lookup[chars]
+    if (codes == 255).any():
+        raise ValueError(f"strings contain characters outside {alphabet!r}")
+    width = -(-codes.shape[1] // per_byte)
+    codes = np.pad(codes, ((0, 0), (0, width*per_byte - codes.shape[1]))).reshape(len(strings), width, per_byte)
+    shifts = (8 - bits*np.arange(1, per_byte + 1)).astype(np.uint8)
+    packed = np.bitwise_or.reduce(codes << shifts, axis=2).astype(np.uint8)
+    length_type = np.uint16 if lengths.max(initial=0) < 2**16 else np.uint32
+    return packed, lengths.astype(length_type)
+
+
+def float_column(values):
+    """MFEs as float32 if every value comes back unchanged through its shortest float32 repr, else float64."""
+    column = np.array(values, dtype=np.float64)
+    narrow = column.astype(np.float32)
+    if all(float(text) == value for text, value in zip(narrow.astype(str).tolist(), column.tolist())):
+        return narrow
+    return column
+
+
+def write_columnar(samples, filename, kind):
+    """Write a list of JSON-style tuples of the given kind ("sequence" or "structure") as a .col file."""
+    schema = SCHEMAS[kind]
+    arrays = []
+    for indx, (name, encoding, alphabet) in enumerate(schema):
+        values = [sample[indx] for sample in samples]
+        if encoding == "packed":
+            packed, lengths = pack_strings(values, alphabet)
+            arrays.append((name, {"encoding": encoding, "alphabet": alphabet}, packed))
+            arrays.append((name + "_len", {"encoding": "length"}, lengths))
+        else:
+            arrays.append((name, {"encoding": encoding}, float_column(values)))
+
+    columns = []
+    offset = 0
+    for name, info, array in arrays:
+        columns.append({"name": name, **info, "dtype": array.dtype.str, "shape": list(array.shape), "offset": offset})
+        offset += -(-array.nbytes // ALIGNMENT)*ALIGNMENT
+    header = {"kind": kind, "rows": len(samples), "columns": columns}
+    header_bytes = json.dumps(header).encode('ascii')
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT)*ALIGNMENT
+    with open(filename + ".tmp", 'wb') as f:
+        f.write(MAGIC + len(header_bytes).to_bytes(8, 'little') + header_bytes)
+        for column, (_, _, array) in zip(columns, arrays):
+            f.seek(data_start + column["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(filename + ".tmp", filename)
+
+
+class RowView(Sequence):
+    """One example of a ColumnarDataset; each field is decoded when it is read, and the row unpacks like the JSON tuple."""
+    __slots__ = ("dataset", "index")
+
+    def __init__(self, dataset, index):
+        self.dataset = dataset
+        self.index = index
+
+    def __len__(self):
+        return len(self.dataset.fields)
+
+    def __getitem__(self, field):
+        if isinstance(field, slice):
+            return tuple(self)[field]
+        if field < 0:
+            field += len(self)
+        if not 0 <= field < len(self):
+            raise IndexError("row field index out of range")
+        return self.dataset.field(self.index, field)
+
+    def __iter__(self):
+        return (self.dataset.field(self.index, field) for field in range(len(self)))
+
+    def __eq__(self, other):
+        return isinstance(other, (Sequence, RowView)) and not isinstance(other, str) and list(self) == list(other)
+
+    def __repr__(self):
+        return repr(tuple(self))
+
+
+class ColumnarDataset(Sequence):
+    """A memory-mapped .col file, indexed and sliced like the list json.load returns.
+
+    Indexing gives a lazy RowView, slicing gives a view of a range of rows without copying, and
+    iterating decodes the rows in chunks and yields plain tuples.
+    """
+
+    def __init__(self, filename, rows=None, _mapped=None):
+        self.filename = filename
+        if _mapped is None:
+            with open(filename, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    raise ValueError(f"{filename} is not a columnar dataset")
+                header_length = int.from_bytes(f.read(8), 'little')
+                header = json.loads(f.read(header_length))
+            data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT)*ALIGNMENT
+            buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+            columns = {}
+            for column in header["columns"]:
+                dtype = np.dtype(column["dtype"])
+                start = data_start + column["offset"]
+                count = int(np.prod(column["shape"]))
+                columns[column["name"]] = (column, buffer[start:start + count*dtype.itemsize].view(dtype).reshape(column["shape"]))
+            _mapped = (header, columns, {name: unpack_table(column["alphabet"]) for name, (column, _) in columns.items()
+                                         if column["encoding"] == "packed"})
+        self._mapped = _mapped
+        self.header, self.columns, self.tables = _mapped
+        self.kind = self.header["kind"]
+        self.fields = [name for name, _, _ in SCHEMAS[self.kind]]
+        self.rows = rows if rows is not None else range(self.header["rows"])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, indx):
+        if isinstance(indx, slice):
+            return ColumnarDataset(self.filename, self.rows[indx], self._mapped)
+        return RowView(self, self.rows[indx])
+
+    def field(self, row, field):
+        name = self.fields[field]
+        column, values = self.columns[name]
+        if column["encoding"] == "float":
+            return float(str(values[row])) if values.dtype == np.float32 else float(values[row])
+        length = int(self.columns[name + "_len"][1][row])
+        return self.tables[name][values[row]].tobytes()[:length].decode('ascii')
+
+    def column(self, name, rows=None):
+        """Decode a whole field of the given rows (all rows of this view by default) into a list."""
+        rows = self.rows if rows is None else rows
+        rows = slice(rows.start, rows.stop, rows.step) if isinstance(rows, range) else rows
+        column, values = self.columns[name]
+        if column["encoding"] == "float":
+            chunk = values[rows]
+            return [float(text) for text in chunk.astype(str).tolist()] if chunk.dtype == np.float32 else chunk.tolist()
+        chars = self.tables[name][values[rows]]
+        width = chars.shape[1]*chars.shape[2]
+        text = chars.tobytes().decode('ascii')
+        lengths = self.columns[name + "_len"][1][rows].tolist()
+        return [text[indx*width:indx*width + length] for indx, length in enumerate(lengths)]
+
+    def __iter__(self):
+        for start in range(0, len(self.rows), ITER_CHUNK):
+            rows = self.rows[start:start + ITER_CHUNK]
+            yield from zip(*(self.column(name, rows) for name in self.fields))
+
+
+def columnar_filename(json_filename):
+    return json_filename[:-len(".json")] + ".col"
+
+
+def json_to_columnar(json_filename, col_filename=None):
+    """Convert a JSON training or validation set to a .col file next to it; the kind follows from the tuple length."""
+    with open(json_filename, 'r') as f:
+        samples = json.load(f)
+    kind = "structure" if samples and len(samples[0]) == 3 else "sequence"
+    col_filename = col_filename or columnar_filename(json_filename)
+    write_columnar(samples, col_filename, kind)
+    return col_filename
+
+
+def columnar_to_json(col_filename, json_filename):
+    """Write a .col file back out in the JSON layout of the generator scripts."""
+    with open(json_filename, 'w') as f:
+        json.dump([list(row) for row in ColumnarDataset(col_filename)], f)
+
+
+def load_dataset(name, directory="training_data"):
+    """Open training_data/{name}.col if it exists, otherwise json.load training_data/{name}.json."""
+    col_filename = f"{directory}/{name}.col"
+    if os.path.exists(col_filename):
+        return ColumnarDataset(col_filename)
+    with open(f"{directory}/{name}.json", 'r') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    # python columnar_dataset.py [file.json ...]: convert the given sets, or all four in training_data
+    filenames = sys.argv[1:] or [f"training_data/{name}.json" for name in
+                                 ["sequence_train_set", "sequence_validation_set", "structure_train_set", "structure_validation_set"]]
+    for filename in filenames:
+        col_filename = json_to_columnar(filename)
+        print(f"{filename} ({os.path.getsize(filename)} bytes) -> {col_filename} ({os.path.getsize(col_filename)} bytes)")
@@ -0,0 +1,40 @@
+import multiprocessing
+from contextlib import contextmanager
+import numpy as np
+import nupack as nup
+from nupack_cache import complex_analysis, ComplexAnalysisCache
+
+# Process-pool plumbing shared by generate_training_sequences.py and generate_training_structures.py.
+# init_worker loads the NUPACK model and analysis cache of a worker into worker_model and
+# worker_cache, which the generate_chunk of each script reads at call time.
+worker_model = None
+worker_cache = None
+
+
+def analyze_strands(strand1, strand2, nupackmodel, cache=None):
+    if cache is not None:
+        return cache.analyze(strand1,strand2)
+    return complex_analysis(strand1,strand2,nupackmodel)
+
+
+def chunk_seed(seed, chunk_index):
+    """Deterministic, well-mixed seed for one chunk of work derived from the global seed."""
+    return int(np.random.SeedSequence(seed, spawn_key=(chunk_index,)).generate_state(1)[0])
+
+
+def init_worker(material, celsius, cache_path):
+    # each worker process loads its own NUPACK model once and reuses it for every chunk
+    global worker_model, worker_cache
+    worker_model = nup.Model(material=material, celsius=celsius)
+    worker_cache = ComplexAnalysisCache(cache_path, material=material, celsius=celsius) if cache_path else None
+
+
+@contextmanager
+def chunk_map(n_workers, cache_path, material='DNA', celsius=20):
+    """An ordered imap over a pool of n_workers workers, or map in this process when n_workers is 1."""
+    if n_workers > 1:
+        with multiprocessing.Pool(n_workers, initializer=init_worker, initargs=(material,celsius,cache_path)) as pool:
+            yield pool.imap
+    else:
+        init_worker(material, celsius, cache_path)
+        yield map
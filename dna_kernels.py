@@ -0,0 +1,80 @@
+import gc
+import sys
+import time
+import numpy as np
+
+# Shared sequence kernels: the reverse complement, the base comparison and the padded windows of
+# the chain-of-thought steps, used by the evaluation, the fine-tuning set builder and the mock
+# server, and the padded character array behind the columnar datasets. Single sequences use
+# str.translate and slicing, which run in C. `python dna_kernels.py [n]` benchmarks them against
+# the per-base helpers they replace.
+COMPLEMENT = str.maketrans("ACGTacgt", "TGCAtgca")
+
+
+def reverse_complement(dna):
+    """Return the reverse complement of a DNA sequence; characters other than bases are kept as they are."""
+    return dna.translate(COMPLEMENT)[::-1]
+
+
+def base_compare(seq1, seq2):
+    """'1' where seq2 has the same base as seq1 and '0' where it differs, over the length of seq2."""
+    return ''.join(['1' if a == b else '0' for a, b in zip(seq2, seq1)])
+
+
+def windows(seq, width=3, pad='_'):
+    """The windows of the padded sequence used by the chain-of-thought steps, one starting at each base."""
+    padded = pad + seq + pad
+    return [padded[indx:indx+width] for indx in range(len(seq))]
+
+
+def pad_rows(strings, fill):
+    """The strings as a (n, longest) uint8 array of their characters, padded with fill, and their lengths."""
+    lengths = np.fromiter((len(string) for string in strings), dtype=np.int64, count=len(strings))
+    width = int(lengths.max()) if len(strings) else 0
+    joined = ''.join([string.ljust(width, fill) for string in strings]).encode('ascii')
+    return np.frombuffer(joined, dtype=np.uint8).reshape(len(strings), width), lengths
+
+
+def dict_reverse_complement(dna):
+    # the helper this module replaces, kept for the benchmark
+    complement = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
+    return ''.join(complement[base] for base in reversed(dna))
+
+
+def indexed_base_compare(seq1, seq2):
+    # the inline loop base_compare replaces, kept for the benchmark
+    return ''.join(['1' if seq2[i] == seq1[i] else '0' for i in range(len(seq2))])
+
+
+def benchmark(n=1000000, seed=23):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(10, 26, size=n)
+    letters = np.frombuffer(b"ACGT", dtype=np.uint8)[rng.integers(0, 4, size=int(lengths.sum()))].tobytes().decode('ascii')
+    ends = np.cumsum(lengths).tolist()
+    seqs = [letters[end-length:end] for end, length in zip(ends, lengths.tolist())]
+    others = seqs[1:] + seqs[:1]
+    seqs1 = [other[:len(seq)].ljust(len(seq), 'A') for seq, other in zip(seqs, others)]
+
+    def timed(name, fn):
+        gc.collect()
+        gc.disable()
+        start = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - start
+        gc.enable()
+        print(f"{name:44s} {seconds:7.3f} s  {seconds/n*1e9:8.1f} ns per sequence")
+
+    def consume(fn, items):
+        for item in items:
+            fn(item)
+
+    print(f"{n} sequences of 10-25 bases")
+    timed("reverse complement, dict per base", lambda: consume(dict_reverse_complement, seqs))
+    timed("reverse complement, str.translate", lambda: consume(reverse_complement, seqs))
+    timed("base compare, indexed loop", lambda: [indexed_base_compare(seq1, seq) for seq1, seq in zip(seqs1, seqs)])
+    timed("base compare, zip", lambda: [base_compare(seq1, seq) for seq1, seq in zip(seqs1, seqs)])
+    timed("windows", lambda: consume(windows, seqs))
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import asyncio
+import openai
+import openai_client
+from upload_cache import UploadManifest, upload_file_async
+
+# Drives any number of fine-tuning jobs from one event loop. Every step a job takes (file
+# uploaded, job created, job finished) is written to a local ledger before moving on, so a
+# restarted orchestrator reattaches to the jobs already running instead of starting them again.
+# Jobs are polled with a backoff that resets whenever a job reports a new event, and the
+# model_ids file of a condition is rewritten as soon as one of its jobs succeeds.
+LEDGER_PATH = "fine_tune_ledger.json"
+BASE_MODEL = "gpt-3.5-turbo-1106"
+TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+# the shared client is built with max_retries=0, so these are retried here rather than ending the job
+TRANSIENT_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+
+def job_key(outname, train_size):
+    return f"{outname}_train_size_{train_size}"
+
+
+def write_json(filename, data, indent=None):
+    # written to a temporary file first so an interrupted write never leaves a truncated file
+    with open(filename + ".tmp", 'w') as f:
+        json.dump(data, f, indent=indent)
+    os.replace(filename + ".tmp", filename)
+
+
+class FineTuneLedger:
+    """Local record of every fine-tuning job: its training file, uploaded file id, job id, status and model."""
+
+    def __init__(self, filename=LEDGER_PATH):
+        self.filename = filename
+        self.jobs = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self.jobs = json.load(f)
+
+    def add(self, outname, train_size, base_model=BASE_MODEL):
+        key = job_key(outname, train_size)
+        if key not in self.jobs:
+            self.jobs[key] = {"outname": outname, "train_size": train_size, "base_model": base_model,
+                              "training_file": f"fine_tune_sets/{outname}_train_size_{train_size}.jsonl",
+                              "file_id": None, "job_id": None, "status": "pending", "fine_tuned_model": None,
+                              "last_event_id": None}
+            self.save()
+        return key
+
+    def update(self, key, **fields):
+        self.jobs[key].update(fields)
+        self.save()
+
+    def save(self):
+        write_json(self.filename, self.jobs, indent=1)
+
+    def unfinished(self):
+        return [key for key, job in self.jobs.items() if job["status"] not in TERMINAL_STATUSES]
+
+    def models(self, outname):
+        """(train_size, model id) of every succeeded job of a condition, by train size."""
+        return sorted((job["train_size"], job["fine_tuned_model"]) for job in self.jobs.values()
+                      if job["outname"] == outname and job["status"] == "succeeded")
+
+
+def update_model_ids(ledger, outname):
+    """Add the succeeded models of a condition to model_ids/{outname}_models_ts.json, keeping entries already there."""
+    filename = f"model_ids/{outname}_models_ts.json"
+    model_list = {}
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            model_list = {train_size: modelid for train_size, modelid in json.load(f)}
+    model_list.update(ledger.models(outname))
+    write_json(filename, sorted([train_size, modelid] for train_size, modelid in model_list.items()))
+
+
+class FineTuneOrchestrator:
+
+    def __init__(self, ledger=None, manifest=None, min_poll_interval=5, max_poll_interval=300, backoff_factor=1.5):
+        self.ledger = ledger if ledger is not None else FineTuneLedger()
+        self.manifest = manifest if manifest is not None else UploadManifest()
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff_factor = backoff_factor
+
+    def next_interval(self, interval, active):
+        if active:
+            return self.min_poll_interval
+        return min(self.max_poll_interval, interval*self.backoff_factor)
+
+    async def api(self, key, request):
+        """Await request() until it gets past transient API errors, backing off between attempts."""
+        interval = self.min_poll_interval
+        while True:
+            try:
+                return await request()
+            except TRANSIENT_ERRORS as e:
+                print(f"{key}: {type(e).__name__}, retrying in {interval:.0f} s")
+                await asyncio.sleep(interval)
+                interval = self.next_interval(interval, False)
+
+    async def upload(self, key):
+        job = self.ledger.jobs[key]
+        client = openai_client.get_client()
+        if job["file_id"] is None:
+            file_id = await self.api(key, lambda: upload_file_async(client, job["training_file"], manifest=self.manifest))
+            print(f"{key}: training file {file_id}")
+            self.ledger.update(key, file_id=file_id, status="uploaded")
+        interval = self.min_poll_interval
+        while True:
+            file_handle = await self.api(key, lambda: client.files.retrieve(job["file_id"]))
+            if file_handle.status == "processed":
+                return
+            if file_handle.status == "error":
+                raise RuntimeError(f"{key}: training file {job['file_id']} could not be processed")
+            await asyncio.sleep(interval)
+            interval = self.next_interval(interval, False)
+
+    async def new_events(self, key):
+        """Print the job's events since the last one seen and return how many there were."""
+        job = self.ledger.jobs[key]
+        page = await self.api(key, lambda: openai_client.get_client().fine_tuning.jobs.list_events(job["job_id"], limit=50))
+        events = []
+        for event in page.data:  # newest first
+            if event.id == job["last_event_id"]:
+                break
+            events.append(event)
+        for event in reversed(events):
+            print(f"{key}: {event.message}")
+        if events:
+            self.ledger.update(key, last_event_id=events[0].id)
+        return len(events)
+
+    async def wait_for_job(self, key):
+        job = self.ledger.jobs[key]
+        client = openai_client.get_client()
+        interval = self.min_poll_interval
+        while True:
+            job_handle = await self.api(key, lambda: client.fine_tuning.jobs.retrieve(job["job_id"]))
+            active = await self.new_events(key) > 0
+            if job_handle.status != job["status"]:
+                # the model id is recorded together with the final status, never after it
+                self.ledger.update(key, status=job_handle.status, fine_tuned_model=job_handle.fine_tuned_model)
+            if job_handle.status in TERMINAL_STATUSES:
+                return job_handle
+            # newer API versions estimate when the job will finish; no need to poll much before that
+            estimated_finish = getattr(job_handle, "estimated_finish", None)
+            wait = interval
+            if estimated_finish is not None:
+                wait = max(wait, min(self.max_poll_interval, estimated_finish - time.time()))
+            await asyncio.sleep(wait)
+            interval = self.next_interval(interval, active)
+
+    async def run_job(self, key):
+        """Take one job from wherever the ledger left it to a finished model."""
+        job = self.ledger.jobs[key]
+        if job["job_id"] is None:
+            await self.upload(key)
+            ftjob = await self.api(key, lambda: openai_client.get_client().fine_tuning.jobs.create(training_file=job["file_id"], model=job["base_model"]))
+            print(f"{key}: started fine-tuning job {ftjob.id}")
+            self.ledger.update(key, job_id=ftjob.id, status=ftjob.status)
+        else:
+            print(f"{key}: reattached to fine-tuning job {job['job_id']} ({job['status']})")
+        job_handle = await self.wait_for_job(key)
+        if job_handle.status == "succeeded":
+            update_model_ids(self.ledger, job["outname"])
+            print(f"{key}: model id {job_handle.fine_tuned_model}")
+        else:
+            print(f"{key}: fine-tuning ended with status {job_handle.status} {job_handle.error}")
+        return job_handle.fine_tuned_model
+
+    async def run(self, keys):
+        """Run the given jobs at once; a failing job is reported without stopping the others."""
+        results = await asyncio.gather(*(self.run_job(key) for key in keys), return_exceptions=True)
+        for key, result in zip(keys, results):
+            if isinstance(result, Exception):
+                print(f"{key}: {type(result).__name__}: {result}")
+        return {key: self.ledger.jobs[key]["fine_tuned_model"] for key in keys}
+
+
+def fine_tune_models(outname, train_sizes, base_model=BASE_MODEL, ledger_path=LEDGER_PATH, retry_failed=False):
+    """Fine-tune a model per train size, or reattach to jobs already in the ledger, and return their model ids."""
+    ledger = FineTuneLedger(ledger_path)
+    keys = [ledger.add(outname, ts, base_model) for ts in train_sizes]
+    for key in keys:
+        if retry_failed and ledger.jobs[key]["status"] in ("failed", "cancelled"):
+            ledger.update(key, job_id=None, status="pending", last_event_id=None)
+    todo = [key for key in keys if ledger.jobs[key]["status"] != "succeeded"]
+    orchestrator = FineTuneOrchestrator(ledger)
+    openai_client.run_async(orchestrator.run(todo))
+    return [ledger.jobs[key]["fine_tuned_model"] for key in keys]
+
+
+def resume_all(ledger_path=LEDGER_PATH):
+    """Reattach to every unfinished job in the ledger, e.g. after the machine running them restarted."""
+    ledger = FineTuneLedger(ledger_path)
+    orchestrator = FineTuneOrchestrator(ledger)
+    return openai_client.run_async(orchestrator.run(ledger.unfinished()))
+
+
+if __name__ == '__main__':
+    resume_all()
@@ -1,24 +1,12 @@
 import random
 import json
+import multiprocessing
 import numpy as np
 from tqdm import tqdm
-import nupack as nup
-
-def reverse_complement(dna):
-    """Return the reverse complement of a DNA sequence."""
-    complement = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
-    return ''.join(complement[base] for base in reversed(dna))
-
-
-def analyze_strands(strand1, strand2, nupackmodel):
-    A = nup.Strand(strand1, name='A')
-    B = nup.Strand(strand2, name='B')
-    c1 = nup.Complex([A,B]) 
-    complex_set = nup.ComplexSet(strands={A: 1e-8, B: 1e-8}, complexes=nup.SetSpec(max_size=0, include=[c1]))
-    complex_analysis = nup.complex_analysis(complex_set, compute=['mfe','pfunc', 'pairs'], model=nupackmodel)
-    complex_vals = complex_analysis[c1]
-    return complex_vals
-
+import design_workers
+from design_workers import analyze_strands, chunk_seed, chunk_map
+from nupack_cache import NUPACK_CACHE_PATH
+from nupack_design import design_targets, DESIGN_FAILURES_PATH
 
 def generate_secondary_structure(seq_length,num_mismatches):
     dp_comp = {'(': ')', '.':'.'}
@@ -31,59 +19,66 @@ def generate_secondary_structure(seq_length,num_mismatches):
     dotpar = ''.join(start_strand + list('+') + end_strand)
     return dotpar
 
-def sequence_design(dotpar,seq_length,nupackmodel):
-    f = nup.Domain(f'N{seq_length}', name='f')
-    g = nup.Domain(f'N{seq_length}', name='g')
-    F = nup.TargetStrand([f], name='Strand F')
-    G = nup.TargetStrand([g], name='Strand G')
-    Ct = nup.TargetComplex([F,G], dotpar, name='Ct')
-    t1 = nup.TargetTube(on_targets={Ct: 1e-8}, name='t1')
-    # sim1 = nup.Similarity([f,g], f'S{seq_length*2}', limits=[0.3, 0.7])
-    my_design = nup.tube_design(tubes=[t1], hard_constraints=[], soft_constraints=[], defect_weights=None, options=None, model=nupackmodel)
-    while True:
-        try:
-            my_results = my_design.run(trials=1)
-            strand1 = str(my_results[0].to_analysis(F))
-            strand2 = str(my_results[0].to_analysis(G))
-            break
-        except:
-            None
-    return strand1, strand2
-
-
-def get_sequence(seq_length,num_mismatches, nupackmodel):
-    dotpar = generate_secondary_structure(seq_length,num_mismatches)
-    strand1, strand2 = sequence_design(dotpar,seq_length,nupackmodel)
-    return strand1,strand2
-
-def generate_training_sequences():
-    training_size = 11000
-    nupackmodel = nup.Model(material='DNA',celsius=20)
+
+def design_sequences(n_targets, nupackmodel, batch_size=16, trials=1, design_seed=None):
+    """Design n_targets random structures in batches and return the sequence pairs of every trial."""
+    dotpars = []
+    for _ in range(n_targets):
+        seq_len = random.randint(10,25)
+        num_mismatches = max(1,random.randint(0,round(seq_len*0.3)))
+        dotpars.append(generate_secondary_structure(seq_len,num_mismatches))
+    designs, _ = design_targets(dotpars,nupackmodel,batch_size=batch_size,trials=trials,design_seed=design_seed,failure_log=DESIGN_FAILURES_PATH)
+    return [pair for candidates in designs for pair in candidates]
+
+
+def sequence_example(seq1, seq2, nupackmodel, cache=None):
+    complex_vals = analyze_strands(seq1,seq2,nupackmodel,cache=cache)
+    mfe = round(complex_vals["mfe"],1)
+    dotpar = complex_vals["structure"]
+    #Get base-pair probabilities
+    pair_array = complex_vals["pairs"]
+    np.fill_diagonal(pair_array, 0)
+    rounded_array=np.around(pair_array)
+    total_pair_prob = rounded_array.sum(axis=0)
+    prob_string = np.array2string(total_pair_prob, separator='', max_line_width=np.inf).replace('[', '').replace(']', '').replace(',', '').replace('.', '')
+    return (seq1,seq2,mfe,prob_string,dotpar)
+
+
+def generate_chunk(args):
+    seed, chunk_size, batch_size, trials = args
+    random.seed(seed)
+    model, cache = design_workers.worker_model, design_workers.worker_cache
+    pairs = design_sequences(chunk_size,model,batch_size=batch_size,trials=trials,design_seed=random.randint(1,2**31-1))
+    return [sequence_example(seq1,seq2,model,cache=cache) for seq1, seq2 in pairs]
+
+
+def generate_examples(training_size, seed, n_workers, chunk_size, cache_path, batch_size=16, trials=1):
+    # Work is split into fixed-size chunks whose seeds depend only on (seed, chunk index) and the
+    # chunks are consumed in index order, in a process pool or in this process for one worker, so
+    # the deduplicated output is reproducible for a given seed whatever the number of workers.
     all_data = []
     seqs = set()
-    with tqdm(total=training_size) as pbar: 
+    next_chunk = 0
+    with chunk_map(n_workers, cache_path) as imap, tqdm(total=training_size) as pbar:
         while len(seqs) < training_size:
-            seq_len = random.randint(10,25)
-            num_mismatches = max(1,random.randint(0,round(seq_len*0.3)))
-            while True: #keep generating sequence pairs until a unique set is found
-                seq1, seq2 = get_sequence(seq_len,num_mismatches,nupackmodel)
-                if (seq1,seq2) not in seqs and (seq2, seq1) not in seqs:
-                    complex_vals = analyze_strands(seq1,seq2,nupackmodel)
-                    mfe = round(complex_vals.mfe[0].energy,1)
-                    dotpar = str(complex_vals.mfe[0].structure)
-                    #Get base-pair probabilities
-                    pair_array = complex_vals.pairs.to_array()
-                    np.fill_diagonal(pair_array, 0)
-                    rounded_array=np.around(pair_array)
-                    total_pair_prob = rounded_array.sum(axis=0)
-                    prob_string = np.array2string(total_pair_prob, separator='', max_line_width=np.inf).replace('[', '').replace(']', '').replace(',', '').replace('.', '')
-                    all_data.append((seq1,seq2,mfe,prob_string,dotpar))
-                    seqs.add((seq1,seq2))
-                    pbar.update(1)
-                    break           
-
-
+            n_chunks = max(n_workers, -(-(training_size-len(seqs))//chunk_size))
+            args = [(chunk_seed(seed,indx),chunk_size,batch_size,trials) for indx in range(next_chunk,next_chunk+n_chunks)]
+            next_chunk += n_chunks
+            for chunk in imap(generate_chunk, args):
+                for seq1, seq2, mfe, prob_string, dotpar in chunk:
+                    if len(seqs) < training_size and (seq1,seq2) not in seqs and (seq2, seq1) not in seqs:
+                        all_data.append((seq1,seq2,mfe,prob_string,dotpar))
+                        seqs.add((seq1,seq2))
+                        pbar.update(1)
+    return all_data
+
+
+def generate_training_sequences(n_workers=1, seed=23, chunk_size=50, cache_path=NUPACK_CACHE_PATH, batch_size=16, trials=1):
+    training_size = 11000
+    all_data = generate_examples(training_size, seed, n_workers, chunk_size, cache_path, batch_size, trials)
 
+    # chunks run in this process reseed random, so the split is seeded after them
+    random.seed(seed)
     # Randomly generate indices for train and validation split
     train_indices = random.sample(range(training_size), training_size-1000)
     val_indices = list(set(range(training_size)) - set(train_indices))
@@ -99,6 +94,6 @@ def generate_training_sequences():
         json.dump(val_set,f)
 
 if __name__ == '__main__':
-    random.seed(23)
-    generate_training_sequences()
+    generate_training_sequences(seed=23)
+    # generate_training_sequences(n_workers=multiprocessing.cpu_count(), seed=23)
 
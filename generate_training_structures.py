@@ -1,80 +1,66 @@
 import random
 import json
-import numpy as np
+import multiprocessing
 from tqdm import tqdm
-import nupack as nup
-
-def reverse_complement(dna):
-    """Return the reverse complement of a DNA sequence."""
-    complement = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
-    return ''.join(complement[base] for base in reversed(dna))
-
-def analyze_strands(strand1, strand2, nupackmodel):
-    A = nup.Strand(strand1, name='A')
-    B = nup.Strand(strand2, name='B')
-    c1 = nup.Complex([A,B]) 
-    complex_set = nup.ComplexSet(strands={A: 1e-8, B: 1e-8}, complexes=nup.SetSpec(max_size=0, include=[c1]))
-    complex_analysis = nup.complex_analysis(complex_set, compute=['mfe','pfunc', 'pairs'], model=nupackmodel)
-    complex_vals = complex_analysis[c1]
-    return complex_vals
-
-
-def generate_secondary_structure(seq_length,num_mismatches):
-    dp_comp = {'(': ')', '.':'.'}
-    start_strand = list('('*seq_length)
-    allinds = list(range(0,seq_length))
-    mis_inds = random.sample(allinds,num_mismatches)
-    for ind in mis_inds:
-        start_strand[ind] = '.'
-    end_strand =  [dp_comp[base] for base in reversed(start_strand)]
-    dotpar = ''.join(start_strand + list('+') + end_strand)
-    return dotpar
-
-def sequence_design(dotpar,seq_length,nupackmodel):
-    f = nup.Domain(f'N{seq_length}', name='f')
-    g = nup.Domain(f'N{seq_length}', name='g')
-    F = nup.TargetStrand([f], name='Strand F')
-    G = nup.TargetStrand([g], name='Strand G')
-    Ct = nup.TargetComplex([F,G], dotpar, name='Ct')
-    t1 = nup.TargetTube(on_targets={Ct: 1e-8}, name='t1')
-    # sim1 = nup.Similarity([f,g], f'S{seq_length*2}', limits=[0.3, 0.7])
-    my_design = nup.tube_design(tubes=[t1], hard_constraints=[], soft_constraints=[], model=nupackmodel)
-    while True:
-        try:
-            my_results = my_design.run(trials=1)
-            strand1 = str(my_results[0].to_analysis(F))
-            strand2 = str(my_results[0].to_analysis(G))
-            break
-        except:
-            None
-    return strand1, strand2
-
-
-def get_sequence(seq_length,num_mismatches, nupackmodel):
-    dotpar = generate_secondary_structure(seq_length,num_mismatches)
-    strand1, strand2 = sequence_design(dotpar,seq_length,nupackmodel)
-    return strand1,strand2
-
-def generate_training_structures():
-    training_size = 11000
-    nupackmodel = nup.Model(material='DNA',celsius=20)
+import design_workers
+from design_workers import analyze_strands, chunk_seed, chunk_map
+from nupack_cache import NUPACK_CACHE_PATH
+from structure_sampler import StructureSampler
+from nupack_design import design_targets, DESIGN_FAILURES_PATH
+
+
+def design_folded(dotpars, nupackmodel, cache=None, batch_size=16, trials=1, design_seed=None):
+    """Design the targets in batches and return, per target, the first (strand1, strand2) that folds into it, or None."""
+    designs, _ = design_targets(dotpars,nupackmodel,batch_size=batch_size,trials=trials,design_seed=design_seed,failure_log=DESIGN_FAILURES_PATH)
+    return [next(((strand1,strand2) for strand1, strand2 in candidates
+                  if analyze_strands(strand1,strand2,nupackmodel,cache=cache)["structure"] == dotpar), None)
+            for dotpar, candidates in zip(dotpars, designs)]
+
+
+def record_designs(sampler, dotpars, folded):
+    """Report the outcome of every target to the sampler and return the (dotpar, strand1, strand2) that folded."""
+    examples = []
+    for dotpar, pair in zip(dotpars, folded):
+        sampler.record(dotpar,pair is not None)
+        if pair is not None:
+            examples.append((dotpar,)+pair)
+    return examples
+
+
+def generate_chunk(args):
+    design_seed, dotpars, batch_size, trials = args
+    return design_folded(dotpars,design_workers.worker_model,cache=design_workers.worker_cache,batch_size=batch_size,trials=trials,design_seed=design_seed)
+
+
+def generate_examples(training_size, seed, n_workers, chunk_size, cache_path, batch_size=16, trials=1):
+    # The targets of every chunk are drawn here from one sampler and the outcomes are recorded here
+    # in chunk order, so targets are unique across chunks and the per-class statistics see every
+    # design. Each round has just enough chunks for the examples still missing, whatever the number
+    # of workers, and chunk seeds depend only on (seed, chunk index), so the output is reproducible
+    # and the same in a process pool as in this process for one worker.
+    sampler = StructureSampler()
     all_data = []
-    structures = set()
-    with tqdm(total=training_size) as pbar: 
-        while len(structures) < training_size:
-            seq_len = random.randint(10,25)
-            num_mismatches = max(1,random.randint(0,round(seq_len*0.3)))
-            # while True: #keep generating structures until a unique one is found
-            dotpar = generate_secondary_structure(seq_len,num_mismatches)
-            if dotpar not in structures:
-                strand1, strand2 = sequence_design(dotpar,seq_len,nupackmodel)
-                complex_vals = analyze_strands(strand1,strand2,nupackmodel)
-                mfe_dotpar = str(complex_vals.mfe[0].structure)
-                if mfe_dotpar == dotpar:
-                    structures.add((dotpar))
-                    all_data.append((dotpar,strand1,strand2))
-                    pbar.update(1)
-                              
+    next_chunk = 0
+    with chunk_map(n_workers, cache_path) as imap, tqdm(total=training_size) as pbar:
+        while len(all_data) < training_size:
+            missing = training_size-len(all_data)
+            args = []
+            for start in range(0, missing, chunk_size):
+                dotpars = [sampler.draw() for _ in range(min(chunk_size, missing-start))]
+                args.append((chunk_seed(seed,next_chunk),dotpars,batch_size,trials))
+                next_chunk += 1
+            for (_, dotpars, _, _), folded in zip(args, imap(generate_chunk, args)):
+                examples = record_designs(sampler, dotpars, folded)
+                all_data += examples
+                pbar.update(len(examples))
+    sampler.report()
+    return all_data
+
+
+def generate_training_structures(n_workers=1, seed=23, chunk_size=50, cache_path=NUPACK_CACHE_PATH, batch_size=16, trials=1):
+    training_size = 11000
+    random.seed(seed)
+    all_data = generate_examples(training_size, seed, n_workers, chunk_size, cache_path, batch_size, trials)
 
     # Randomly generate indices for train and validation split
     train_indices = random.sample(range(training_size), training_size-1000)
@@ -91,6 +77,6 @@ def generate_training_structures():
         json.dump(val_set,f)
 
 if __name__ == '__main__':
-    random.seed(23)
-    generate_training_structures()
+    generate_training_structures(seed=23)
+    # generate_training_structures(n_workers=multiprocessing.cpu_count(), seed=23)
 
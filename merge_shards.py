@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import telemetry
+from performance_test import load_validation_set, results_filename, sample_structure, shard_bounds, shard_filename
+
+# A run split with performance_test(..., shard_index=i, shard_count=k) leaves k shard files, each
+# holding a contiguous slice of the validation set. merge_shards checks that together they hold
+# every validation sample exactly once, in order, and writes them to the results file that a
+# single unsharded run would have written, along with the merged telemetry.
+
+
+def read_shard(filename, experiment, val_set, start, end):
+    """Return the lines of a shard file after checking them against val_set[start:end]."""
+    if not os.path.exists(filename):
+        raise FileNotFoundError(f"shard file {filename} is missing")
+    with open(filename, 'r') as f:
+        lines = f.readlines()
+    if lines and not lines[-1].endswith('\n'):
+        raise ValueError(f"{filename} ends in a partial line; finish the shard with resume=True")
+    if len(lines) != end - start:
+        raise ValueError(f"{filename} holds {len(lines)} results but its shard has {end - start} samples")
+    for offset, line in enumerate(lines):
+        if json.loads(line)["structure"] != sample_structure(experiment, val_set[start + offset]):
+            raise ValueError(f"{filename} does not match the validation set at line {offset+1}")
+    return lines
+
+
+def merge_telemetry(filenames, bounds, out_filename):
+    """Combine the shard telemetry files, shifting each sample's index to its line in the merged results."""
+    with open(out_filename + ".tmp", 'w') as out:
+        for filename, (start, end) in zip(filenames, bounds):
+            with open(filename, 'r') as f:
+                for line in f:
+                    record = json.loads(line)
+                    record["index"] += start
+                    out.write(json.dumps(record) + '\n')
+    os.replace(out_filename + ".tmp", out_filename)
+
+
+def merge_shards(experiment, condition, max_tries, train_size, shard_count, remove=False):
+    val_set = load_validation_set(experiment)
+    out_filename = results_filename(experiment, condition, max_tries, train_size)
+    filenames = [shard_filename(out_filename, indx, shard_count) for indx in range(shard_count)]
+    bounds = [shard_bounds(len(val_set), indx, shard_count) for indx in range(shard_count)]
+
+    # every shard is checked before anything is written, so a failed merge leaves no results file
+    shards = [read_shard(filename, experiment, val_set, start, end) for filename, (start, end) in zip(filenames, bounds)]
+    with open(out_filename + ".tmp", 'w') as f:
+        for lines in shards:
+            f.writelines(lines)
+    os.replace(out_filename + ".tmp", out_filename)
+    print(f"merged {shard_count} shards into {out_filename} ({len(val_set)} samples)")
+
+    telemetry_filenames = [telemetry.telemetry_filename(filename) for filename in filenames]
+    if all(os.path.exists(filename) for filename in telemetry_filenames):
+        merge_telemetry(telemetry_filenames, bounds, telemetry.telemetry_filename(out_filename))
+    else:
+        print("some shards have no telemetry file, telemetry was not merged")
+        telemetry_filenames = [filename for filename in telemetry_filenames if os.path.exists(filename)]
+
+    if remove:
+        for filename in filenames + telemetry_filenames:
+            os.remove(filename)
+
+
+if __name__ == '__main__':
+    # python merge_shards.py <experiment> <condition or "none"> <max_tries> <train_size> <shard_count>
+    experiment, condition, max_tries, train_size, shard_count = sys.argv[1:6]
+    merge_shards(experiment, None if condition == "none" else condition, int(max_tries), int(train_size), int(shard_count))
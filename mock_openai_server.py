@@ -0,0 +1,508 @@
+import os
+import re
+import json
+import time
+import uuid
+import random
+import threading
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dna_kernels import reverse_complement, windows
+from columnar_dataset import load_dataset
+
+# Local stand-in for the parts of the OpenAI API used by this project: chat completions (with n and
+# streaming), files, fine-tuning jobs and batches. Answers are built from the ground truth in
+# training_data and then perturbed at configurable rates, and every request can be delayed, hung
+# past the client timeout or refused with a 429, so the evaluation engine can be benchmarked
+# offline. Point the clients at it with
+#     OPENAI_BASE_URL=http://127.0.0.1:8000/v1 OPENAI_API_KEY=mock
+EXPERIMENTS = ["reverse_complement", "secondary_structure", "minimum_free_energy", "sequence_design"]
+DEFAULT_OPTIONS = {
+    "error_rate": 0.1,          # fraction of answers that are well formed but wrong
+    "invalid_rate": 0.05,       # fraction of answers that fail validation
+    "latency_median": 1.0,      # median seconds before a response, drawn from a lognormal
+    "latency_sigma": 0.5,
+    "token_latency": 0.0,       # extra seconds per completion token
+    "timeout_rate": 0.0,        # fraction of requests that hang for hang_seconds
+    "hang_seconds": 600,
+    "rate_limit_rate": 0.0,     # fraction of requests refused with a 429 at random
+    "server_error_rate": 0.0,   # fraction of requests answered with a 500
+    "rpm": 10000,               # requests and tokens per minute before every request gets a 429
+    "tpm": 2000000,
+    "fine_tune_seconds": 30,    # how long a fine-tuning job runs before it succeeds
+    "batch_seconds": 5,         # how long a batch takes to complete
+    "seed": 23,
+}
+
+
+def n_tokens(text):
+    # rough count, good enough for usage numbers and the tokens-per-minute limit
+    return max(1, len(text)//4)
+
+
+def model_condition(experiment, name):
+    """Return the condition in a model_ids or fine_tune_sets file name, e.g. "naive" for reverse_complement_naive_models.json."""
+    name = os.path.splitext(os.path.basename(name))[0]
+    name = re.sub(r'(_models(_ts)?|_train_size_\d+)$', '', name)
+    if name == experiment:
+        return None
+    return name[len(experiment)+1:]
+
+
+def load_model_registry():
+    """Map every model id in model_ids/ to the experiment and condition it was fine-tuned for."""
+    registry = {}
+    if not os.path.isdir("model_ids"):
+        return registry
+    for filename in sorted(os.listdir("model_ids")):
+        experiment = next((exp for exp in EXPERIMENTS if filename.startswith(exp)), None)
+        if experiment is None:
+            continue
+        with open(f"model_ids/{filename}", 'r') as f:
+            for _, modelid in json.load(f):
+                registry[modelid] = (experiment, model_condition(experiment, filename))
+    return registry
+
+
+class GroundTruth:
+    """Answers looked up from the training and validation sets, with a simple duplex model for anything else."""
+
+    def __init__(self):
+        self.pairs = {}
+        self.designs = {}
+        for name in ["sequence_train_set", "sequence_validation_set"]:
+            if os.path.exists(f"training_data/{name}.json") or os.path.exists(f"training_data/{name}.col"):
+                for seq1, seq2, mfe, prob_string, dotpar in load_dataset(name):
+                    self.pairs[(seq1, seq2)] = (mfe, dotpar)
+                    self.pairs[(seq1, reverse_complement(seq2))] = (mfe, dotpar)
+        for name in ["structure_train_set", "structure_validation_set"]:
+            if os.path.exists(f"training_data/{name}.json") or os.path.exists(f"training_data/{name}.col"):
+                for dotpar, seq1, seq2 in load_dataset(name):
+                    self.designs[dotpar] = (seq1, seq2)
+
+    def duplex(self, seq1, seq2, rev2_given):
+        """Return the MFE and structure of a strand pair; seq2 is already reverse complemented if rev2_given."""
+        rev2 = seq2 if rev2_given else reverse_complement(seq2)
+        if (seq1, seq2) in self.pairs:
+            return self.pairs[(seq1, seq2)]
+        # unseen pair: bases that match the reverse complement are paired, the rest are left open
+        half = ''.join('(' if a == b else '.' for a, b in zip(seq1, rev2))
+        dotpar = half + '+' + half[::-1].replace('(', ')')
+        mfe = round(-1.5*half.count('(') + 0.5*half.count('.'), 1)
+        return mfe, dotpar
+
+    def design(self, dotpar, rng):
+        """Return seq1 and rev2 for a strand pair that forms dotpar."""
+        if dotpar in self.designs:
+            seq1, seq2 = self.designs[dotpar]
+            return seq1, reverse_complement(seq2)
+        half = dotpar.split('+')[0]
+        seq1 = ''.join(rng.choice('GCTA') for _ in half)
+        rev2 = ''.join(base if char == '(' else rng.choice([b for b in 'GCTA' if b != base]) for base, char in zip(seq1, half))
+        return seq1, rev2
+
+
+def pair_trace(seq1, rev2, dotpar):
+    return ' '.join(f"[{window1},{window2}]:{dotpar[:i+1]}" for i, (window1, window2) in enumerate(zip(windows(seq1), windows(rev2))))
+
+
+def design_trace(dotpar, seq1, seq2):
+    half = dotpar.split('+')[0]
+    return ' '.join(f"[{window}]:[{seq1[:i+1]},{seq2[:i+1]}]" for i, window in enumerate(windows(half[:len(seq1)])))
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # the evaluation engine opens many connections at once
+
+    def __init__(self, address, **options):
+        super().__init__(address, MockOpenAIHandler)
+        self.options = {**DEFAULT_OPTIONS, **options}
+        self.rng = random.Random(self.options["seed"])
+        self.lock = threading.Lock()
+        self.truth = GroundTruth()
+        self.registry = load_model_registry()
+        self.files = {}
+        self.jobs = {}
+        self.batches = {}
+        self.recent = []  # (time, tokens) of the requests in the last minute
+        self.stats = {"requests": 0, "rate_limited": 0, "timeouts": 0, "server_errors": 0}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def draw(self):
+        with self.lock:
+            return self.rng.random()
+
+    def admit(self, tokens):
+        """Return None if a request may proceed, or the seconds to wait if it is over the rate limits."""
+        with self.lock:
+            now = time.time()
+            self.recent = [(t, n) for t, n in self.recent if now - t < 60]
+            self.stats["requests"] += 1
+            if len(self.recent) >= self.options["rpm"] or sum(n for _, n in self.recent) + tokens > self.options["tpm"]:
+                self.stats["rate_limited"] += 1
+                return max(0.1, 60 - (now - self.recent[0][0])) if self.recent else 1.0
+            if self.rng.random() < self.options["rate_limit_rate"]:
+                self.stats["rate_limited"] += 1
+                return 1.0
+            self.recent.append((now, tokens))
+            return None
+
+    def rate_limit_headers(self):
+        with self.lock:
+            used_requests = len(self.recent)
+            used_tokens = sum(n for _, n in self.recent)
+            reset = max(0.0, 60 - (time.time() - self.recent[0][0])) if self.recent else 0.0
+        return {"x-ratelimit-limit-requests": str(self.options["rpm"]),
+                "x-ratelimit-remaining-requests": str(max(0, self.options["rpm"]-used_requests)),
+                "x-ratelimit-reset-requests": f"{reset:.3f}s",
+                "x-ratelimit-limit-tokens": str(self.options["tpm"]),
+                "x-ratelimit-remaining-tokens": str(max(0, self.options["tpm"]-used_tokens)),
+                "x-ratelimit-reset-tokens": f"{reset:.3f}s"}
+
+    def latency(self, completion_tokens):
+        with self.lock:
+            base = self.rng.lognormvariate(0, self.options["latency_sigma"])
+        return self.options["latency_median"]*base + self.options["token_latency"]*completion_tokens
+
+    def model_task(self, modelid):
+        if modelid in self.registry:
+            return self.registry[modelid]
+        if modelid.startswith("ft:mock:"):
+            stem = modelid[len("ft:mock:"):]
+            experiment = next((exp for exp in EXPERIMENTS if stem.startswith(exp)), None)
+            if experiment is not None:
+                return experiment, model_condition(experiment, stem)
+        return None, "naive"
+
+    def answer(self, modelid, messages):
+        """Return one assistant message for the request, perturbed according to error_rate and invalid_rate."""
+        system = messages[0]["content"]
+        user = messages[-1]["content"]
+        condition = self.model_task(modelid)[1] or "naive"
+        cot = "CoT" in condition
+        draw = self.draw()
+        wrong = draw < self.options["error_rate"]
+        invalid = self.options["error_rate"] <= draw < self.options["error_rate"] + self.options["invalid_rate"]
+        with self.lock:
+            rng = random.Random(self.rng.random())
+
+        def mutate(string, alphabet):
+            indx = rng.randrange(len(string))
+            return string[:indx] + rng.choice([c for c in alphabet if c != string[indx]]) + string[indx+1:]
+
+        if "DNA designer" in system:
+            dotpar = user.strip()
+            seq1, rev2 = self.truth.design(dotpar, rng)
+            if wrong:
+                seq1 = mutate(seq1, 'GCTA')
+            seq2 = rev2 if "rev2" in condition else reverse_complement(rev2)
+            answer = f"{seq1} {seq2}"
+            trace = design_trace(dotpar, seq1, seq2)
+        elif "reverse complement" in system:
+            seq2 = user.strip()
+            answer = reverse_complement(seq2)
+            if wrong:
+                answer = mutate(answer, 'GCTA')
+            trace = ' '.join(f"{seq2[:len(seq2)-i]},{seq2[-(i+1)]}:{answer[:i+1]}" for i in range(len(seq2)))
+        elif "minimum free energy" in system:
+            seq1, seq2 = user.split()[:2]
+            rev2_given = "rev_comp" in condition
+            mfe, dotpar = self.truth.duplex(seq1, seq2, rev2_given)
+            if wrong:
+                mfe = mfe + rng.choice([-1, 1])*round(rng.uniform(0.1, 3.0), 1)
+            answer = f"{min(mfe, -0.1):.1f}"
+            trace = pair_trace(seq1, seq2 if rev2_given else reverse_complement(seq2), dotpar.split('+')[0])
+        else:
+            seq1, seq2 = user.split()[:2]
+            rev2_given = "rev_comp" in condition
+            _, answer = self.truth.duplex(seq1, seq2, rev2_given)
+            if wrong:
+                answer = mutate(answer, '().')
+            trace = pair_trace(seq1, seq2 if rev2_given else reverse_complement(seq2), answer.split('+')[0])
+        if invalid:
+            # one base or bracket short, or a positive free energy
+            answer = answer.lstrip('-') if "minimum free energy" in system else answer[:-1]
+        if cot:
+            return f"{trace} ans:{answer}"
+        return answer
+
+    def chat_completion(self, body):
+        n = body.get("n", 1) or 1
+        contents = [self.answer(body["model"], body["messages"]) for _ in range(n)]
+        prompt_tokens = sum(n_tokens(message["content"]) for message in body["messages"])
+        completion_tokens = sum(n_tokens(content) for content in contents)
+        return {"id": f"chatcmpl-{uuid.uuid4().hex[:24]}", "object": "chat.completion", "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{"index": indx, "finish_reason": "stop", "logprobs": None,
+                             "message": {"role": "assistant", "content": content}} for indx, content in enumerate(contents)],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens}}
+
+    def file_object(self, file_id):
+        entry = self.files[file_id]
+        return {"id": file_id, "object": "file", "bytes": len(entry["content"]), "created_at": entry["created_at"],
+                "filename": entry["filename"], "purpose": entry["purpose"], "status": "processed"}
+
+    def add_file(self, filename, purpose, content):
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        with self.lock:
+            self.files[file_id] = {"filename": filename, "purpose": purpose, "content": content, "created_at": int(time.time())}
+        return file_id
+
+    def job_object(self, job_id):
+        job = self.jobs[job_id]
+        elapsed = time.time() - job["created_at"]
+        status = "validating_files" if elapsed < 1 else "running"
+        finished_at = None
+        if job["cancelled"]:
+            status = "cancelled"
+        elif elapsed >= self.options["fine_tune_seconds"]:
+            status = "succeeded"
+            finished_at = int(job["created_at"] + self.options["fine_tune_seconds"])
+        return {"id": job_id, "object": "fine_tuning.job", "created_at": int(job["created_at"]), "error": None,
+                "fine_tuned_model": job["fine_tuned_model"] if status == "succeeded" else None,
+                "finished_at": finished_at, "hyperparameters": {"n_epochs": 3}, "model": job["model"],
+                "organization_id": "org-mock", "result_files": [], "seed": 0, "status": status,
+                "trained_tokens": job["trained_tokens"] if status == "succeeded" else None,
+                "training_file": job["training_file"], "validation_file": None}
+
+    def job_events(self, job_id):
+        job = self.job_object(job_id)
+        events = [("Validating training file", self.jobs[job_id]["created_at"])]
+        if job["status"] in ("running", "succeeded"):
+            events.append(("Fine-tuning job started", self.jobs[job_id]["created_at"] + 1))
+        if job["status"] == "succeeded":
+            events.append(("The job has successfully completed", job["finished_at"]))
+        if job["status"] == "cancelled":
+            events.append(("Fine-tuning job cancelled", time.time()))
+        data = [{"id": f"ftevent-{job_id}-{indx}", "object": "fine_tuning.job.event", "created_at": int(created),
+                 "level": "info", "message": message} for indx, (message, created) in enumerate(events)]
+        return {"object": "list", "data": data[::-1], "has_more": False}
+
+    def batch_object(self, batch_id):
+        batch = self.batches[batch_id]
+        status = "completed" if batch["output_file_id"] is not None else "in_progress"
+        return {"id": batch_id, "object": "batch", "endpoint": batch["endpoint"], "errors": None,
+                "input_file_id": batch["input_file_id"], "completion_window": "24h", "status": status,
+                "output_file_id": batch["output_file_id"], "error_file_id": None, "created_at": int(batch["created_at"]),
+                "request_counts": {"total": batch["total"], "completed": batch["total"] if status == "completed" else 0, "failed": 0}}
+
+    def run_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        lines = []
+        for line in self.files[batch["input_file_id"]]["content"].decode().splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            if self.draw() < self.options["server_error_rate"]:
+                response = {"status_code": 500, "request_id": uuid.uuid4().hex, "body": {"error": {"message": "mock server error"}}}
+            else:
+                response = {"status_code": 200, "request_id": uuid.uuid4().hex, "body": self.chat_completion(request["body"])}
+            lines.append(json.dumps({"id": f"batch_req_{uuid.uuid4().hex[:24]}", "custom_id": request["custom_id"], "response": response, "error": None}))
+        time.sleep(self.options["batch_seconds"])
+        output_file_id = self.add_file(f"{batch_id}_output.jsonl", "batch_output", ('\n'.join(lines) + '\n').encode())
+        with self.lock:
+            batch["output_file_id"] = output_file_id
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body are separate writes; without this each response waits on a delayed ACK
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message, headers=None):
+        self.send_json(status, {"error": {"message": message, "type": "mock_error", "code": None}}, headers)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+    def route(self, method):
+        server = self.server
+        path = self.path.split('?')[0].rstrip('/')
+        path = path[len("/v1"):] if path.startswith("/v1") else path
+        body = self.read_body()
+        try:
+            if method == "POST" and path == "/chat/completions":
+                return self.chat_completions(json.loads(body))
+            if method == "POST" and path == "/files":
+                return self.upload_file(body)
+            match = re.fullmatch(r"/files/([\w-]+)(/content)?", path)
+            if match and match.group(1) in server.files:
+                file_id = match.group(1)
+                if method == "DELETE":
+                    with server.lock:
+                        del server.files[file_id]
+                    return self.send_json(200, {"id": file_id, "object": "file", "deleted": True})
+                if match.group(2):
+                    content = server.files[file_id]["content"]
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(len(content)))
+                    self.end_headers()
+                    return self.wfile.write(content)
+                return self.send_json(200, server.file_object(file_id))
+            if method == "POST" and path == "/fine_tuning/jobs":
+                return self.create_job(json.loads(body))
+            if method == "GET" and path == "/fine_tuning/jobs":
+                data = [server.job_object(job_id) for job_id in server.jobs][::-1]
+                return self.send_json(200, {"object": "list", "data": data, "has_more": False})
+            match = re.fullmatch(r"/fine_tuning/jobs/([\w-]+)(/events|/cancel)?", path)
+            if match and match.group(1) in server.jobs:
+                job_id = match.group(1)
+                if match.group(2) == "/events":
+                    return self.send_json(200, server.job_events(job_id))
+                if match.group(2) == "/cancel":
+                    with server.lock:
+                        server.jobs[job_id]["cancelled"] = True
+                return self.send_json(200, server.job_object(job_id))
+            if method == "POST" and path == "/batches":
+                return self.create_batch(json.loads(body))
+            match = re.fullmatch(r"/batches/([\w-]+)", path)
+            if match and match.group(1) in server.batches:
+                return self.send_json(200, server.batch_object(match.group(1)))
+            return self.send_error_json(404, f"no such resource: {method} {self.path}")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up on this request, e.g. after its timeout
+            self.close_connection = True
+        except Exception as e:
+            self.send_error_json(500, f"mock server failed on {method} {self.path}: {e!r}")
+
+    def chat_completions(self, body):
+        server = self.server
+        prompt_tokens = sum(n_tokens(message["content"]) for message in body["messages"])
+        wait = server.admit(prompt_tokens)
+        if wait is not None:
+            headers = {"retry-after": f"{wait:.3f}", **server.rate_limit_headers()}
+            return self.send_error_json(429, "Rate limit reached for requests", headers)
+        if server.draw() < server.options["server_error_rate"]:
+            with server.lock:
+                server.stats["server_errors"] += 1
+            return self.send_error_json(500, "The server had an error while processing your request.")
+        if server.draw() < server.options["timeout_rate"]:
+            with server.lock:
+                server.stats["timeouts"] += 1
+            time.sleep(server.options["hang_seconds"])
+
+        completion = server.chat_completion(body)
+        delay = server.latency(completion["usage"]["completion_tokens"])
+        if not body.get("stream"):
+            time.sleep(delay)
+            return self.send_json(200, completion, server.rate_limit_headers())
+
+        # server-sent events, a few characters per chunk, spread over the response latency
+        chunk_size = 16
+        contents = [choice["message"]["content"] for choice in completion["choices"]]
+        n_chunks = max(len(content) for content in contents)//chunk_size + 1
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        for key, value in server.rate_limit_headers().items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.close_connection = True
+
+        def send_chunk(choices):
+            chunk = {"id": completion["id"], "object": "chat.completion.chunk", "created": completion["created"],
+                     "model": completion["model"], "choices": choices}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+
+        send_chunk([{"index": indx, "delta": {"role": "assistant", "content": ""}, "finish_reason": None} for indx in range(len(contents))])
+        for step in range(n_chunks):
+            time.sleep(delay/n_chunks)
+            choices = [{"index": indx, "delta": {"content": content[step*chunk_size:(step+1)*chunk_size]}, "finish_reason": None}
+                       for indx, content in enumerate(contents) if content[step*chunk_size:(step+1)*chunk_size]]
+            if choices:
+                send_chunk(choices)
+        send_chunk([{"index": indx, "delta": {}, "finish_reason": "stop"} for indx in range(len(contents))])
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def upload_file(self, body):
+        message = BytesParser(policy=policy.default).parsebytes(b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + body)
+        fields = {}
+        filename = "upload.jsonl"
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is not None:
+                filename = part.get_filename()
+            fields[name] = part.get_payload(decode=True)
+        file_id = self.server.add_file(filename, fields.get("purpose", b"fine-tune").decode(), fields["file"])
+        self.send_json(200, self.server.file_object(file_id))
+
+    def create_job(self, body):
+        server = self.server
+        if body["training_file"] not in server.files:
+            return self.send_error_json(400, f"invalid training file {body['training_file']}")
+        training_file = server.files[body["training_file"]]
+        job_id = f"ftjob-{uuid.uuid4().hex[:24]}"
+        # the fine-tuned model answers in the format of the condition its training file was built for
+        fine_tuned_model = f"ft:mock:{os.path.splitext(training_file['filename'])[0]}"
+        with server.lock:
+            server.jobs[job_id] = {"created_at": time.time(), "model": body["model"], "training_file": body["training_file"],
+                                   "fine_tuned_model": fine_tuned_model, "cancelled": False,
+                                   "trained_tokens": 3*n_tokens(training_file["content"].decode(errors="ignore"))}
+        self.send_json(200, server.job_object(job_id))
+
+    def create_batch(self, body):
+        server = self.server
+        if body["input_file_id"] not in server.files:
+            return self.send_error_json(400, f"invalid input file {body['input_file_id']}")
+        batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+        total = sum(1 for line in server.files[body["input_file_id"]]["content"].splitlines() if line.strip())
+        with server.lock:
+            server.batches[batch_id] = {"created_at": time.time(), "endpoint": body["endpoint"], "input_file_id": body["input_file_id"],
+                                        "output_file_id": None, "total": total}
+        threading.Thread(target=server.run_batch, args=(batch_id,), daemon=True).start()
+        self.send_json(200, server.batch_object(batch_id))
+
+
+def start_server(host="127.0.0.1", port=8000, **options):
+    """Start the mock server on a background thread and return it; server.base_url is the URL for the clients."""
+    server = MockOpenAIServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    host = "127.0.0.1"
+    port = 8000
+    options = {"error_rate": 0.1, "invalid_rate": 0.05, "latency_median": 1.0, "latency_sigma": 0.5,
+               "timeout_rate": 0.01, "rate_limit_rate": 0.02, "rpm": 3500, "tpm": 2000000}
+
+    server = MockOpenAIServer((host, port), **options)
+    print(f"Mock OpenAI API listening on {server.base_url}")
+    print(f"export OPENAI_BASE_URL={server.base_url} OPENAI_API_KEY=mock")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.stats)
+        server.server_close()
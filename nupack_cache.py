@@ -0,0 +1,120 @@
+import json
+import time
+import sqlite3
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nupack as nup
+
+NUPACK_CACHE_PATH = "nupack_cache.sqlite"
+
+
+def complex_analysis(strand1, strand2, nupackmodel, compute=('mfe','pfunc','pairs')):
+    """Run NUPACK complex analysis on the A+B duplex and return the plain values the scripts use."""
+    A = nup.Strand(strand1, name='A')
+    B = nup.Strand(strand2, name='B')
+    c1 = nup.Complex([A,B])
+    complex_set = nup.ComplexSet(strands={A: 1e-8, B: 1e-8}, complexes=nup.SetSpec(max_size=0, include=[c1]))
+    complex_analysis = nup.complex_analysis(complex_set, compute=list(compute), model=nupackmodel)
+    complex_vals = complex_analysis[c1]
+    result = {"mfe": None, "structure": None, "pairs": None}
+    if 'mfe' in compute:
+        result["mfe"] = complex_vals.mfe[0].energy
+        result["structure"] = str(complex_vals.mfe[0].structure)
+    if 'pairs' in compute:
+        result["pairs"] = complex_vals.pairs.to_array()
+    return result
+
+
+def init_analysis_worker(material, celsius):
+    # each worker process loads its NUPACK model once and keeps it for the life of the pool
+    global worker_model
+    worker_model = nup.Model(material=material, celsius=celsius)
+
+
+def worker_complex_analysis(strand1, strand2, compute):
+    return complex_analysis(strand1, strand2, worker_model, compute)
+
+
+def analysis_pool(n_workers=None, material='DNA', celsius=20):
+    """Process pool for running complex_analysis off the calling process; use with worker_complex_analysis."""
+    return ProcessPoolExecutor(n_workers, initializer=init_analysis_worker, initargs=(material, celsius))
+
+
+class ComplexAnalysisCache:
+    """Content-addressed SQLite cache of complex_analysis results.
+
+    Entries are keyed by (strand1, strand2, material, celsius, compute set) and hold the MFE, the
+    MFE dot-paren structure and the pair-probability matrix. The least recently used entries are
+    evicted once the cache grows past max_entries. NUPACK is only loaded on the first miss.
+    """
+
+    def __init__(self, path=NUPACK_CACHE_PATH, material='DNA', celsius=20, max_entries=1000000):
+        self.path = path
+        self.material = material
+        self.celsius = celsius
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.nupackmodel = None
+        # several pool workers may share one cache file
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS analyses (
+            key TEXT PRIMARY KEY, mfe REAL, structure TEXT, pairs BLOB, pairs_dim INTEGER, last_used REAL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS analyses_last_used ON analyses(last_used)")
+        self.conn.commit()
+
+    def key(self, strand1, strand2, compute):
+        key_fields = [strand1, strand2, self.material, self.celsius, sorted(compute)]
+        return hashlib.sha256(json.dumps(key_fields).encode()).hexdigest()
+
+    def get(self, strand1, strand2, compute=('mfe','pfunc','pairs')):
+        """Return the cached result, or None (counted as a miss) if it has not been computed yet."""
+        key = self.key(strand1, strand2, compute)
+        row = self.conn.execute("SELECT mfe, structure, pairs, pairs_dim FROM analyses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE analyses SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        mfe, structure, pairs, pairs_dim = row
+        if pairs is not None:
+            pairs = np.frombuffer(pairs, dtype=np.float64).reshape(pairs_dim, pairs_dim).copy()
+        return {"mfe": mfe, "structure": structure, "pairs": pairs}
+
+    def put(self, strand1, strand2, compute, result):
+        pairs = result["pairs"]
+        self.conn.execute("INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?, ?, ?)",
+            (self.key(strand1, strand2, compute), result["mfe"], result["structure"],
+             None if pairs is None else np.ascontiguousarray(pairs, dtype=np.float64).tobytes(),
+             None if pairs is None else pairs.shape[0], time.time()))
+        self.conn.commit()
+        if self.misses % 1000 == 0:
+            self.evict()
+
+    def analyze(self, strand1, strand2, compute=('mfe','pfunc','pairs')):
+        result = self.get(strand1, strand2, compute)
+        if result is None:
+            if self.nupackmodel is None:
+                self.nupackmodel = nup.Model(material=self.material, celsius=self.celsius)
+            result = complex_analysis(strand1, strand2, self.nupackmodel, compute)
+            self.put(strand1, strand2, compute, result)
+        return result
+
+    def evict(self):
+        # trim to 90% of the bound so eviction does not run on every insert once the cache is full
+        count = self.conn.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+        if count > self.max_entries:
+            n_remove = count - int(self.max_entries*0.9)
+            self.conn.execute("DELETE FROM analyses WHERE key IN (SELECT key FROM analyses ORDER BY last_used LIMIT ?)", (n_remove,))
+            self.conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits/total if total else 0.0}
+
+    def close(self):
+        self.evict()
+        self.conn.close()
@@ -0,0 +1,106 @@
+import sys
+import json
+import time
+import random
+import nupack as nup
+from nupack_cache import complex_analysis
+
+# Sequence design of many duplex targets per NUPACK job. Every target gets its own domains,
+# strands and tube in one tube_design, so the setup and model loading of a design job are paid
+# once per batch instead of once per example. The tubes share no strands, but they do share one
+# design objective and one stop condition: a hard target keeps the whole batch optimizing, and an
+# easy one can be stopped with a higher defect than it would reach alone, so the batch size can
+# change design quality as well as speed. All trials of a job are kept, giving every target one
+# candidate sequence pair per trial.
+#
+# A job that raises is split in half and both halves are run again, so one bad target does not
+# take the rest of its batch with it. A target that still fails on its own is retried up to
+# max_attempts times and then recorded as a failure instead of being retried forever.
+DESIGN_FAILURES_PATH = "design_failures.jsonl"
+
+
+def duplex_design(dotpars, nupackmodel, trials=1, design_seed=None):
+    """Design every duplex target in one tube_design and return the (strand1, strand2) of each trial, per target."""
+    strands = []
+    tubes = []
+    for indx, dotpar in enumerate(dotpars):
+        len1 = dotpar.index('+')
+        f = nup.Domain(f'N{len1}', name=f'f{indx}')
+        g = nup.Domain(f'N{len(dotpar) - len1 - 1}', name=f'g{indx}')
+        F = nup.TargetStrand([f], name=f'Strand F{indx}')
+        G = nup.TargetStrand([g], name=f'Strand G{indx}')
+        Ct = nup.TargetComplex([F,G], dotpar, name=f'Ct{indx}')
+        tubes.append(nup.TargetTube(on_targets={Ct: 1e-8}, name=f't{indx}'))
+        strands.append((F, G))
+    options = nup.DesignOptions(seed=design_seed) if design_seed is not None else None
+    my_design = nup.tube_design(tubes=tubes, hard_constraints=[], soft_constraints=[], defect_weights=None, options=options, model=nupackmodel)
+    my_results = my_design.run(trials=trials)
+    return [[(str(result.to_analysis(F)), str(result.to_analysis(G))) for result in my_results] for F, G in strands]
+
+
+def design_targets(dotpars, nupackmodel, batch_size=16, trials=1, max_attempts=3, design_seed=None, failure_log=None):
+    """Design all targets in batches of batch_size and return (designs, failures).
+
+    designs[i] is the list of (strand1, strand2) candidates of dotpars[i], one per trial, and is
+    empty if the target failed max_attempts times on its own. failures holds a dict per failed
+    target, and is also appended to the JSONL file failure_log if one is given. With design_seed,
+    the k-th job run uses seed design_seed + k, so a run is reproducible.
+    """
+    designs = [[] for _ in dotpars]
+    attempts = [0]*len(dotpars)
+    failures = []
+    # a stack of batches, in order, so the halves of a failed batch are run next
+    pending = [list(range(start, min(start + batch_size, len(dotpars)))) for start in range(0, len(dotpars), batch_size)][::-1]
+    jobs = 0
+    while pending:
+        batch = pending.pop()
+        seed = (design_seed + jobs) % 2**31 if design_seed is not None else None
+        jobs += 1
+        try:
+            results = duplex_design([dotpars[indx] for indx in batch], nupackmodel, trials, seed)
+        except Exception as error:
+            if len(batch) > 1:
+                half = len(batch) // 2
+                pending += [batch[half:], batch[:half]]
+                continue
+            indx = batch[0]
+            attempts[indx] += 1
+            if attempts[indx] < max_attempts:
+                pending.append(batch)
+            else:
+                failures.append({"dotpar": dotpars[indx], "attempts": attempts[indx], "error": f"{type(error).__name__}: {error}"})
+            continue
+        for indx, candidates in zip(batch, results):
+            designs[indx] = candidates
+    if failures and failure_log:
+        with open(failure_log, 'a') as f:
+            for failure in failures:
+                f.write(json.dumps(failure) + "\n")
+    return designs, failures
+
+
+def benchmark(n=64, batch_sizes=(1, 4, 16, 64), trials=(1, 4), seed=23):
+    """Designs per CPU-second of the one-at-a-time loop (batch size 1, 1 trial) against batched jobs.
+
+    A design counts when the MFE structure of its strands is the target; the check is not timed.
+    """
+    from structure_sampler import StructureSampler
+    random.seed(seed)
+    sampler = StructureSampler()
+    dotpars = [sampler.draw() for _ in range(n)]
+    nupackmodel = nup.Model(material='DNA', celsius=20)
+    print(f"{n} targets of 10-25 base pairs")
+    for batch_size in batch_sizes:
+        for n_trials in trials:
+            start = time.process_time()
+            designs, failures = design_targets(dotpars, nupackmodel, batch_size=batch_size, trials=n_trials, design_seed=seed)
+            seconds = time.process_time() - start
+            candidates = sum(len(candidates) for candidates in designs)
+            folded = sum(complex_analysis(strand1, strand2, nupackmodel, compute=('mfe',))["structure"] == dotpar
+                         for dotpar, candidates in zip(dotpars, designs) for strand1, strand2 in candidates)
+            print(f"batch size {batch_size:3d}, {n_trials} trials: {seconds:7.2f} CPU s, {candidates/seconds:7.2f} designs per CPU s, "
+                  f"{folded/seconds:7.2f} folded per CPU s, {len(failures)} failed")
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 64)
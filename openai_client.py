@@ -0,0 +1,275 @@
+import time
+import asyncio
+from collections import deque
+import numpy as np
+import httpx
+import openai
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from rate_limiter import RateLimiter
+
+# Shared client layer for every chat completion made during evaluation. One long-lived AsyncOpenAI
+# client keeps HTTP connections alive between requests, timeouts are enforced by the HTTP client
+# itself (so a timed out request is actually closed), and a single rate limiter paces the
+# requests of all samples and nested expert calls against the account's request and token limits.
+max_connections = 64
+max_in_flight = 64
+max_request_attempts = 8  # sends of one request before 429s and server errors count as a timeout
+requests_per_minute = None
+tokens_per_minute = None
+client = None
+limiter = None
+
+
+def configure(connections=None, in_flight=None, rpm=None, tpm=None):
+    """Set the connection pool size, the maximum number of requests in flight and the starting rate limits.
+
+    rpm and tpm only seed the limiter; it follows the limits reported in the response headers.
+    """
+    global max_connections, max_in_flight, requests_per_minute, tokens_per_minute, limiter
+    if connections is not None:
+        max_connections = connections
+    if in_flight is not None:
+        max_in_flight = in_flight
+    if rpm is not None:
+        requests_per_minute = rpm
+    if tpm is not None:
+        tokens_per_minute = tpm
+    limiter = None
+
+
+def get_client():
+    global client
+    if client is None:
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=60)
+        # retries are left to the callers' validation loops
+        client = AsyncOpenAI(http_client=httpx.AsyncClient(limits=limits), max_retries=0)
+    return client
+
+
+def get_limiter():
+    global limiter
+    if limiter is None:
+        limiter = RateLimiter(max_concurrency=max_in_flight, rpm=requests_per_minute, tpm=tokens_per_minute)
+    return limiter
+
+
+async def close():
+    global client
+    if client is not None:
+        await client.close()
+    client = None
+    # the limiter keeps what it learned about the rate limits for the next run
+    if limiter is not None:
+        limiter.detach()
+
+
+def run_async(coro):
+    """Run an evaluation coroutine to completion from synchronous code.
+
+    The client is bound to the event loop it is first used on, so it is released when the
+    coroutine finishes and rebuilt for the next run.
+    """
+    async def main():
+        try:
+            return await coro
+        finally:
+            await close()
+    return asyncio.run(main())
+
+
+class RequestTiming:
+    """When send_with_limits last got a request past the rate limiter, and how long that HTTP request took."""
+
+    def __init__(self):
+        self.sent = None
+        self.latency = None
+
+
+async def send_with_limits(message, request, n=1, timing=None):
+    """Send request() under the rate limiter, retrying 429s, server errors and dropped connections.
+
+    request() returns (response, headers, completion_tokens). Returns the response, or None if the
+    request timed out or could not be sent in max_request_attempts attempts. timing, a
+    RequestTiming, is filled in without the time spent waiting for the limiter or between retries.
+    """
+    limiter = get_limiter()
+    tokens = limiter.estimate_tokens(message, n)
+    for attempt in range(max_request_attempts):
+        delay = 0
+        started = await limiter.acquire(tokens)
+        if timing is not None:
+            timing.sent = time.monotonic()
+        try:
+            response, headers, completion_tokens = await request()
+            if response is None:
+                return None
+        except openai.APITimeoutError:
+            return None
+        except openai.RateLimitError as e:
+            # the limiter holds back every request until the limit is expected to reset
+            limiter.throttled(started, e.response.headers, attempt)
+        except (openai.InternalServerError, openai.APIConnectionError):
+            delay = limiter.backoff(attempt)
+        else:
+            used_tokens = response.usage.total_tokens if response.usage is not None else None
+            limiter.succeeded(headers, tokens, used_tokens, completion_tokens, n)
+            if timing is not None:
+                timing.latency = time.monotonic() - timing.sent
+            return response
+        finally:
+            limiter.release()
+        await asyncio.sleep(delay)
+    return None
+
+
+async def chat_completion(message, timeout_duration, modelid, timing=None, **params):
+    """Request a chat completion, returning None if it does not finish within timeout_duration seconds."""
+    async def request():
+        raw = await get_client().chat.completions.with_raw_response.create(
+            model = modelid,
+            messages = message,
+            timeout = timeout_duration,
+            **params,
+        )
+        response = raw.parse()
+        completion_tokens = response.usage.completion_tokens if response.usage is not None else None
+        return response, raw.headers, completion_tokens
+    return await send_with_limits(message, request, params.get("n", 1), timing)
+
+
+async def stream_chat_completion(message, timeout_duration, modelid, prefix_ok, n=1, timing=None, **params):
+    """Stream a chat completion, dropping each candidate as soon as prefix_ok rejects its text so far.
+
+    The request is closed once every candidate has been dropped. The result is assembled into a
+    ChatCompletion; dropped candidates keep the text received before they were rejected and get
+    finish_reason "length". Returns None if the stream does not finish within timeout_duration seconds.
+    """
+    async def request():
+        contents = [""]*n
+        aborted = [False]*n
+        finish_reasons = ["stop"]*n
+        headers = None
+        async def consume():
+            nonlocal headers
+            raw = await get_client().chat.completions.with_raw_response.create(
+                model = modelid,
+                messages = message,
+                timeout = timeout_duration,
+                stream = True,
+                n = n,
+                **params,
+            )
+            headers = raw.headers
+            stream = raw.parse()
+            try:
+                async for chunk in stream:
+                    for choice in chunk.choices:
+                        if aborted[choice.index]:
+                            continue
+                        if choice.delta.content:
+                            contents[choice.index] += choice.delta.content
+                        if choice.finish_reason is not None:
+                            finish_reasons[choice.index] = choice.finish_reason
+                        if not prefix_ok(contents[choice.index]):
+                            aborted[choice.index] = True
+                            finish_reasons[choice.index] = "length"
+                    if all(aborted):
+                        break
+            finally:
+                await stream.close()
+        try:
+            await asyncio.wait_for(consume(), timeout=timeout_duration)
+        except asyncio.TimeoutError:
+            return None, None, None
+        response = ChatCompletion(id="stream", created=int(time.time()), model=modelid, object="chat.completion",
+            choices=[Choice(index=indx, finish_reason=finish_reasons[indx], message=ChatCompletionMessage(role="assistant", content=contents[indx])) for indx in range(n)])
+        # streamed responses carry no usage, so the completion length is estimated from the text
+        return response, headers, sum(len(content) for content in contents)//4
+    return await send_with_limits(message, request, n, timing)
+
+
+class HedgePolicy:
+    """When to send a duplicate of a slow request, learned from the latencies of recent requests.
+
+    A request that has not answered by the `percentile` of the last `window` latencies gets one
+    duplicate. At most `budget` duplicates are sent per original request (budget <= 1), so hedging
+    can at most double the number of requests.
+    """
+
+    def __init__(self, percentile=95, budget=0.1, window=200, min_samples=20):
+        if not 0 <= budget <= 1:
+            raise ValueError("the hedging budget must be between 0 and 1")
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def deadline(self):
+        if len(self.latencies) < self.min_samples:
+            return None
+        return float(np.percentile(self.latencies, self.percentile))
+
+    def allow_hedge(self):
+        return self.hedges < self.budget*self.requests
+
+    def stats(self):
+        return {"requests": self.requests, "hedges": self.hedges, "hedge_wins": self.hedge_wins, "deadline": self.deadline()}
+
+
+async def hedged_request(send, is_valid, policy):
+    """Run send(timing) and, if it is slower than the policy's deadline, race it against a duplicate.
+
+    Latencies and the deadline count only the HTTP request, from the moment the rate limiter let it
+    through: a request still queued behind the limiter is not slow, and no duplicate is sent while
+    the limiter is paused after a 429. The first response that passes is_valid wins and the other
+    request is cancelled. If neither passes, the first response that arrived (or None if both timed
+    out) is returned.
+    """
+    async def timed(timing):
+        response = await send(timing)
+        if response is not None and timing.latency is not None:
+            policy.latencies.append(timing.latency)
+        return response
+
+    policy.requests += 1
+    primary_timing = RequestTiming()
+    primary = asyncio.ensure_future(timed(primary_timing))
+    tasks = [primary]
+    try:
+        deadline = policy.deadline()
+        while deadline is not None and not primary.done():
+            # the deadline runs from when the request got past the limiter, not from when it was queued
+            sent = primary_timing.sent
+            remaining = deadline if sent is None else sent + deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.wait({primary}, timeout=remaining)
+        if primary.done() or deadline is None or not policy.allow_hedge() or get_limiter().paused():
+            return await primary
+        policy.hedges += 1
+        hedge = asyncio.ensure_future(timed(RequestTiming()))
+        tasks.append(hedge)
+        pending = set(tasks)
+        fallback = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                response = task.result()
+                if response is not None and is_valid(response):
+                    if task is hedge:
+                        policy.hedge_wins += 1
+                    return response
+                if fallback is None:
+                    fallback = response
+        return fallback
+    finally:
+        # the losing request is cancelled, which also closes its connection
+        unfinished = [task for task in tasks if not task.done()]
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
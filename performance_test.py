@@ -1,18 +1,22 @@
+import os
 import json
 import re
+import asyncio
 import numpy as np
 from tqdm import tqdm
-import nupack as nup
+from nupack_cache import complex_analysis, ComplexAnalysisCache, NUPACK_CACHE_PATH, analysis_pool, worker_complex_analysis
 import time
-import concurrent
-from concurrent.futures import ThreadPoolExecutor
-from openai import OpenAI
-client = OpenAI()
-
-def reverse_complement(dna):
-    """Return the reverse complement of a DNA sequence."""
-    complement = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
-    return ''.join(complement[base] for base in reversed(dna))
+import openai_client
+import telemetry
+from dna_kernels import reverse_complement, base_compare
+from columnar_dataset import load_dataset
+from openai_client import run_async
+from pipeline import Stage, run_pipeline
+from response_cache import ResponseCache, RESPONSE_CACHE_PATH
+response_cache = None
+stream_completions = False
+hedging = None  # HedgePolicy settings; None disables hedged requests
+hedge_policies = {}
 
 def is_float(s):
     try:
@@ -22,323 +26,739 @@ def is_float(s):
         return False 
 
 
-def structure_from_strands(strand1, strand2, nupackmodel):
-    A = nup.Strand(strand1, name='A')
-    B = nup.Strand(strand2, name='B')
-    c1 = nup.Complex([A,B]) 
-    complex_set = nup.ComplexSet(strands={A: 1e-8, B: 1e-8}, complexes=nup.SetSpec(max_size=0, include=[c1]))
-    complex_analysis = nup.complex_analysis(complex_set, compute=['mfe','pfunc', 'pairs'], model=nupackmodel)
-    complex_vals = complex_analysis[c1]
-    structure = str(complex_vals.mfe[0].structure)
-    return structure    
-
-
-def call_openai_api(message, timeout_duration, modelid):
-    with ThreadPoolExecutor() as executor:
-        future = executor.submit(client.chat.completions.create, 
-            model = modelid,
-            messages = message,
-        )
-        try:
-            return future.result(timeout=timeout_duration)
-        except concurrent.futures.TimeoutError:
-            print(f"API call timed out for message: {message}")
-            return None
+# checking a design only needs its MFE structure
+VERIFY_COMPUTE = ('mfe',)
 
 
-def test_reverse_complement_model(sampled_sequences,condition,max_tries,retry_delay,timeout_duration, modelid):
-    results = []
-    with tqdm(total=len(sampled_sequences),leave=False) as pbar: 
-        for seq1, seq2, mfe, prob_string, dotpar in sampled_sequences:
-            bad_outputs = 0
-            rev2 = reverse_complement(seq2)
-            res_dic = {     "seq1": seq1,
-                            "seq2": seq2,
-                            "MFE": mfe,
-                            "structure": dotpar,
-                            "prob_string": prob_string,
-                            "rev2": rev2,
-                        }            
-            message = [
-                {"role": "system", "content": "You are a DNA analyzer. Please return the reverse complement of the following sequence."},
-                {"role": "user", "content": f"{seq2}"}
-            ]
-            while True:
-                response = call_openai_api(message,timeout_duration,modelid)
-                if response is not None: #in case of API timeout
-                    out_string = str(response.choices[0].message.content)
-                    if condition == "naive":
-                        ans_string = out_string
-                        valid_out = len(ans_string) == len(seq2) and all(char in 'GCTA' for char in ans_string)
-                    elif condition == "CoT" and "ans:" in out_string:
-                        ans_string = out_string.split("ans:")[1]
-                        valid_out = len(ans_string) == len(seq2) and all(char in 'GCTA' for char in ans_string)
-
-                    if valid_out: #verify correct output form
-                        res_dic["model"] = ans_string
-                        results.append(res_dic)
-                        break
-                    else:
-                        bad_outputs+=1
-                        if bad_outputs == max_tries:
-                            res_dic["model"] = "2"
-                            results.append(res_dic)
-                            break
-                else:
-                    print("timeout, retrying")
-                    time.sleep(retry_delay)
-            pbar.update(1)                    
-    return results
+def structure_from_strands(strand1, strand2, nupackmodel, cache=None):
+    if cache is not None:
+        return cache.analyze(strand1,strand2,VERIFY_COMPUTE)["structure"]
+    return complex_analysis(strand1,strand2,nupackmodel,VERIFY_COMPUTE)["structure"]
 
 
+async def verify_design(strand1, strand2, nupack_pool, nupack_cache):
+    """Return the MFE structure of a designed pair, computed on the NUPACK process pool on a cache miss.
 
-def test_secondary_structure_model(sampled_sequences,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=None):
-    results = []
-    if coe_args:
-        max_tries_rev_comp = coe_args["max_tries"]
-        modelid_rev_comp = coe_args["modelid_rev_comp"]
-    with tqdm(total=len(sampled_sequences),leave=False) as pbar: 
-        for seq1, seq2, mfe, prob_string, dotpar in sampled_sequences:
-            bad_outputs = 0
-            rev2 = reverse_complement(seq2)
-            base_compare_string = ''.join(['1' if rev2[i] == seq1[i] else '0' for i in range(len(rev2))])
-            res_dic = {     "seq1": seq1,
-                            "seq2": seq2,
-                            "MFE": mfe,
-                            "structure": dotpar,
-                            "prob_string": prob_string,
-                            "base_comparison": base_compare_string,
-                        }
-            if condition == "naive" or condition == "rev2CoT" or condition == "seq2CoT":
-                message = [{"role": "system", "content": "You are a DNA analyzer. Please analyze the following DNA sequence pair and produce the secondary structure in parens-dot-plus notation."},
-                {"role": "user", "content": f"{seq1} {seq2}"}]
-            elif condition == "+rev_comp+CoT":
-                message = [{"role": "system", "content": "You are a DNA analyzer. Please analyze the following DNA sequence pair to produce the secondary structure in parens-dot-plus notation."},
-                {"role": "user", "content": f"{seq1} {rev2}"}]
-            elif condition == "CoT_error_check":
-                message = [{"role": "system", "content": "You are a DNA analyzer. Please analyze the following DNA sequence pair to produce the secondary structure in parens-dot-plus notation."},
-                {"role": "user", "content": f"{seq1} {seq2}"}]                
-            elif "+rev_comp_expert+CoT" in condition:
-                rev_comp_res = test_reverse_complement_model([(seq1, seq2, mfe, prob_string, dotpar)],"naive",max_tries_rev_comp,retry_delay,timeout_duration,modelid_rev_comp)
-                model_rev2 = rev_comp_res[0]["model"]
-                message = [{"role": "system", "content": "You are a DNA analyzer. Please analyze the following DNA sequence pair to produce the secondary structure in parens-dot-plus notation."},
-                {"role": "user", "content": f"{seq1} {model_rev2}"}]
-            while True:
-                response = call_openai_api(message,timeout_duration,modelid)
-                valid_out = False
-                if response is not None: #in case of API timeout
-                    out_string = str(response.choices[0].message.content)  
-                    if condition == "naive":
-                        ans_string = out_string
-                        valid_out = len(ans_string) == len(seq1)+len(seq2)+1 and all(char in '().+' for char in ans_string) 
-                    elif "CoT" in condition: 
-                        out_string = out_string.split("ans:")
-                        if len(out_string) == 2:
-                            ans_string = out_string[1]
-                            valid_out = len(ans_string) == len(seq1)+len(seq2)+1 and all(char in '().+' for char in ans_string)
-                    if valid_out:
-                        res_dic.update({"model_structure": ans_string})
-                        if condition == "+rev_comp_expert+CoT":
-                            res_dic.update({"model_rev2": model_rev2})
-                        results.append(res_dic)
-                        break
-                    else:
-                        bad_outputs+=1
-                        if bad_outputs == max_tries:
-                            res_dic.update({"model_structure": "2"})
-                            if condition == "+rev_comp_expert+CoT":
-                                res_dic.update({"model_rev2": model_rev2})
-                            results.append(res_dic)
-                            break                            
-                else:
-                    print("timeout, retrying")
-                    time.sleep(retry_delay)
-            pbar.update(1)                    
-    return results    
+    The event loop keeps issuing API requests while earlier designs are being checked.
+    """
+    start = time.monotonic()
+    result = nupack_cache.get(strand1,strand2,VERIFY_COMPUTE)
+    if result is None:
+        result = await asyncio.get_running_loop().run_in_executor(nupack_pool,worker_complex_analysis,strand1,strand2,VERIFY_COMPUTE)
+        nupack_cache.put(strand1,strand2,VERIFY_COMPUTE,result)
+    telemetry.record_time("nupack_verify",time.monotonic()-start)
+    return result["structure"]
+
+
+def response_candidates(response):
+    return [str(choice.message.content) for choice in response.choices]
 
-def test_mfe_model(sampled_sequences,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=None):
-    results = []
-    if coe_args:
-        max_tries_rev_comp = coe_args["max_tries"]
-        modelid_rev_comp = coe_args["modelid_rev_comp"]    
-    with tqdm(total=len(sampled_sequences)) as pbar: 
-        for seq1, seq2, mfe, prob_string, dotpar in sampled_sequences:
-            bad_outputs = 0
-            rev2 = reverse_complement(seq2)
-            res_dic = {
-                "seq1": seq1,
-                "seq2": seq2,
-                "MFE": mfe,
-                "structure": dotpar,
-                "prob_string": prob_string,                
-            }
-            if condition == "naive" or condition == "rev2CoT":  
-                message = [{"role": "system", "content": "You are a DNA analyzer. Please analyze the following DNA sequence pair and determine the corresponding minimum free energy in kcal/mol."},
-                {"role": "user", "content": f"{seq1} {seq2}"}]
-            elif condition == "+rev_comp+CoT":
-                message = [{"role": "system", "content": "You are a DNA analyzer. Please analyze the following DNA sequence pair and determine the corresponding minimum free energy in kcal/mol."},
-                {"role": "user", "content": f"{seq1} {rev2}"}]
-            elif "+rev_comp_expert+CoT" in condition:
-                rev_comp_res = test_reverse_complement_model([(seq1, seq2, mfe, prob_string, dotpar)],"naive",max_tries_rev_comp,retry_delay,timeout_duration,modelid_rev_comp)
-                model_rev2 = rev_comp_res[0]["model"]                
-                message = [{"role": "system", "content": "You are a DNA analyzer. Please analyze the following DNA sequence pair and determine the corresponding minimum free energy in kcal/mol."},
-                {"role": "user", "content": f"{seq1} {model_rev2}"}]                                
-            elif condition == "+rev_comp+dotpar":
-                message = [{"role": "system", "content": "You are a DNA analyzer. Please analyze the following DNA sequence pair and secondary structure to determine the corresponding minimum free energy in kcal/mol."},
-                {"role": "user", "content": f"{seq1} {rev2} {dotpar}"}]                
-            while True:
-                response = call_openai_api(message,timeout_duration,modelid)
-                valid_out = False
-                if response is not None: #in case of API timeout
-                    out_string = str(response.choices[0].message.content)
-                    if condition == "naive" or condition == "+rev_comp+dotpar":
-                        ans_string = out_string
-                        valid_out = is_float(ans_string) and "-" in ans_string
-                    elif "CoT" in condition and "ans:" in out_string:
-                        ans_string = out_string.split("ans:")[1]
-                        valid_out = is_float(ans_string) and "-" in ans_string
-
-                    if valid_out:
-                        res_dic.update({"model_MFE": ans_string })
-                        if condition =="+rev_comp_expert+CoT":
-                            res_dic.update({"model_rev2": model_rev2})
-                        results.append(res_dic)
-                        break
-                    else:
-                        bad_outputs+=1
-                        if bad_outputs == max_tries:
-                            res_dic.update({"model_MFE": "2" })
-                            if condition =="+rev_comp_expert+CoT":
-                                res_dic.update({"model_rev2": "2"})                            
-                            results.append(res_dic)
-                            break
-                else:
-                    print("timeout, retrying")
-                    time.sleep(retry_delay)
-            pbar.update(1)                    
-    return results    
 
+def max_trace_length(seq_length):
+    # the longest chain-of-thought trace in the fine-tuning sets grows as seq_length*(seq_length+12)
+    return 2*seq_length*(seq_length+12)
 
-def test_sequence_model(structures,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=None):
+
+def stream_prefix_ok(prefix, cot, alphabet, max_answer_length, max_trace, ends_at_ans=False):
+    """Return False once no continuation of a streamed response can pass validation.
+
+    With ends_at_ans the answer is cut off at a second "ans:" and the rest is not checked, as
+    parse_reverse_complement and parse_sequence do.
+    """
+    answer_ok = lambda ans_string: len(ans_string) <= max_answer_length and all(char in alphabet for char in ans_string)
+    if not cot:
+        return answer_ok(prefix)
+    out_string = prefix.split("ans:")
+    if len(out_string) == 1:
+        return len(prefix) <= max_trace
+    ans_string = out_string[1]
+    if answer_ok(ans_string):
+        return True
+    # the text may end in the start of a second "ans:", which would cut the answer off before it
+    return ends_at_ans and any(ans_string.endswith("ans:"[:k]) and answer_ok(ans_string[:-k]) for k in (1, 2, 3))
+
+
+# Short endings that complete any prefix of an answer parse_mfe accepts (float() parses it and it has
+# a "-"): digits, an exponent carrying the "-", or the rest of inf/infinity/nan. A prefix that none
+# of them makes valid cannot be completed at all.
+MFE_COMPLETIONS = ("", "0", "1", "-1", "e-1", "0e-1", "1e-1", "f", "nf", "y", "ty", "ity", "nity", "inity", "n", "an")
+
+
+def valid_mfe(ans_string):
+    return is_float(ans_string) and "-" in ans_string
+
+
+def mfe_prefix_ok(prefix, cot, max_trace):
+    """stream_prefix_ok for minimum free energy answers, rejecting exactly the prefixes parse_mfe can never accept."""
+    if not cot:
+        return any(valid_mfe(prefix + ending) for ending in MFE_COMPLETIONS)
+    out_string = prefix.split("ans:")
+    if len(out_string) == 1:
+        return len(prefix) <= max_trace
+    if len(out_string) > 2:
+        return valid_mfe(out_string[1])  # a second "ans:" ends the answer
+    ans_string = out_string[1]
+    if any(valid_mfe(ans_string + ending) for ending in MFE_COMPLETIONS):
+        return True
+    # the text may end in the start of a second "ans:", which would cut the answer off before it
+    return any(ans_string.endswith("ans:"[:k]) and valid_mfe(ans_string[:-k]) for k in (1, 2, 3))
+
+
+async def call_openai_api(message, timeout_duration, modelid, validate=None, attempt=0, n=1, prefix_ok=None, stage="model"):
+    # validate maps the response text to the parsed answer (None if invalid) and decides what the response cache keeps
+    # stage names the step the call is made for in the sample's telemetry
+    params = {"n": n} if n > 1 else {}
+    start = time.monotonic()
+    if response_cache is not None:
+        response = response_cache.get(modelid,message,params,attempt)
+        if response is not None:
+            telemetry.record_call(stage,time.monotonic()-start,response,message,attempt,cached=True)
+            return response
+    if stream_completions and prefix_ok is not None:
+        send = lambda timing=None: openai_client.stream_chat_completion(message,timeout_duration,modelid,prefix_ok,n=n,timing=timing)
+    else:
+        send = lambda timing=None: openai_client.chat_completion(message,timeout_duration,modelid,timing=timing,**params)
+    if hedging is not None:
+        # latencies differ a lot between models (e.g. CoT vs naive), so each model learns its own deadline
+        if modelid not in hedge_policies:
+            hedge_policies[modelid] = openai_client.HedgePolicy(**hedging)
+        is_valid = lambda response: validate is None or any(validate(out_string) is not None for out_string in response_candidates(response))
+        response = await openai_client.hedged_request(send,is_valid,hedge_policies[modelid])
+    else:
+        response = await send()
+    telemetry.record_call(stage,time.monotonic()-start,response,message,attempt)
+    if response is None:
+        print(f"API call timed out for message: {message}")
+    elif response_cache is not None:
+        valid = validate is None or any(validate(out_string) is not None for out_string in response_candidates(response))
+        response_cache.put(modelid,message,params,attempt,response,valid)
+    return response
+
+
+async def run_samples(sample_fn, samples, concurrency, *args, leave=True, on_result=None, **kwargs):
+    """Evaluate samples concurrently, at most `concurrency` at a time, returning results in input order.
+
+    concurrency may also be a semaphore shared with other runs. If given, on_result(index, res_dic)
+    is called as soon as each sample finishes.
+    """
+    semaphore = concurrency if isinstance(concurrency, asyncio.Semaphore) else asyncio.Semaphore(concurrency)
+    telemetry_log = telemetry.current_log.get()
+    with tqdm(total=len(samples),leave=leave) as pbar:
+        async def run_sample(indx, sample):
+            async with semaphore:
+                record = telemetry.start_sample()
+                res_dic = await sample_fn(sample,*args,**kwargs)
+            if telemetry_log is not None:
+                telemetry_log.write(indx,record)
+            if on_result is not None:
+                on_result(indx,res_dic)
+            pbar.update(1)
+            return res_dic
+        return await asyncio.gather(*(run_sample(indx,sample) for indx, sample in enumerate(samples)))
+
+
+class OrderedResultWriter:
+    """Append results to a JSON-lines file as they finish, keeping validation-set order.
+
+    A result is written (and flushed) as soon as every sample before it has been written, so the
+    file is always a complete prefix of the final output.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.next_index = 0
+        self.finished = {}
+
+    def write(self, indx, res_dic):
+        self.finished[indx] = res_dic
+        while self.next_index in self.finished:
+            self.f.write(json.dumps(self.finished.pop(self.next_index)) + '\n')
+            self.f.flush()
+            self.next_index += 1
+
+
+def sample_structure(experiment, sample):
+    """The target structure of a validation sample, which every result line records as "structure"."""
+    return sample[0] if experiment == "sequence_design" else sample[4]
+
+
+def read_completed_results(filename, val_set, experiment):
+    """Return the number of samples already written to a partial results file.
+
+    A trailing partial line left by an interrupted run is cut off, and the completed lines are
+    checked against the validation set so a file from a different run is not silently extended.
+    """
+    completed = 0
+    valid_bytes = 0
+    with open(filename, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                res_dic = json.loads(line)
+            except ValueError:
+                break
+            if res_dic["structure"] != sample_structure(experiment,val_set[completed]):
+                raise ValueError(f"{filename} does not match the validation set at line {completed+1}")
+            completed += 1
+            valid_bytes += len(line)
+    with open(filename, 'r+b') as f:
+        f.truncate(valid_bytes)
+    return completed
+
+
+def reverse_complement_message(seq2):
+    return [
+        {"role": "system", "content": "You are a DNA analyzer. Please return the reverse complement of the following sequence."},
+        {"role": "user", "content": f"{seq2}"}
+    ]
+
+
+def parse_reverse_complement(out_string, condition, seq2):
+    """Return the answer in a reverse complement response, or None if it is not of the expected form."""
+    if condition == "naive":
+        ans_string = out_string
+    elif condition == "CoT" and "ans:" in out_string:
+        ans_string = out_string.split("ans:")[1]
+    else:
+        return None
+    if len(ans_string) == len(seq2) and all(char in 'GCTA' for char in ans_string):
+        return ans_string
+    return None
+
+
+def secondary_structure_message(condition, seq1, seq2, rev2):
+    if condition == "naive" or condition == "rev2CoT" or condition == "seq2CoT":
+        return [{"role": "system", "content": "You are a DNA analyzer. Please analyze the following DNA sequence pair and produce the secondary structure in parens-dot-plus notation."},
+        {"role": "user", "content": f"{seq1} {seq2}"}]
+    elif condition == "+rev_comp+CoT" or "+rev_comp_expert+CoT" in condition:
+        return [{"role": "system", "content": "You are a DNA analyzer. Please analyze the following DNA sequence pair to produce the secondary structure in parens-dot-plus notation."},
+        {"role": "user", "content": f"{seq1} {rev2}"}]
+    elif condition == "CoT_error_check":
+        return [{"role": "system", "content": "You are a DNA analyzer. Please analyze the following DNA sequence pair to produce the secondary structure in parens-dot-plus notation."},
+        {"role": "user", "content": f"{seq1} {seq2}"}]
+
+
+def parse_secondary_structure(out_string, condition, seq1, seq2):
+    """Return the answer in a secondary structure response, or None if it is not of the expected form."""
+    if condition == "naive":
+        ans_string = out_string
+    elif "CoT" in condition:
+        out_string = out_string.split("ans:")
+        if len(out_string) != 2:
+            return None
+        ans_string = out_string[1]
+    else:
+        return None
+    if len(ans_string) == len(seq1)+len(seq2)+1 and all(char in '().+' for char in ans_string):
+        return ans_string
+    return None
+
+
+def mfe_message(condition, seq1, seq2, rev2, dotpar):
+    if condition == "naive" or condition == "rev2CoT":  
+        return [{"role": "system", "content": "You are a DNA analyzer. Please analyze the following DNA sequence pair and determine the corresponding minimum free energy in kcal/mol."},
+        {"role": "user", "content": f"{seq1} {seq2}"}]
+    elif condition == "+rev_comp+CoT" or "+rev_comp_expert+CoT" in condition:
+        return [{"role": "system", "content": "You are a DNA analyzer. Please analyze the following DNA sequence pair and determine the corresponding minimum free energy in kcal/mol."},
+        {"role": "user", "content": f"{seq1} {rev2}"}]
+    elif condition == "+rev_comp+dotpar":
+        return [{"role": "system", "content": "You are a DNA analyzer. Please analyze the following DNA sequence pair and secondary structure to determine the corresponding minimum free energy in kcal/mol."},
+        {"role": "user", "content": f"{seq1} {rev2} {dotpar}"}]
+
+
+def parse_mfe(out_string, condition):
+    """Return the answer in a minimum free energy response, or None if it is not of the expected form."""
+    if condition == "naive" or condition == "+rev_comp+dotpar":
+        ans_string = out_string
+    elif "CoT" in condition and "ans:" in out_string:
+        ans_string = out_string.split("ans:")[1]
+    else:
+        return None
+    if valid_mfe(ans_string):
+        return ans_string
+    return None
+
+
+def sequence_message(dotpar):
+    return [{"role": "system", "content": "You are a DNA designer. Please design a pair of DNA sequences that will form the following secondary structure."},
+    {"role": "user", "content": f"{dotpar}"}]
+
+
+def parse_sequence(out_string, condition, dotpar):
+    """Return the two designed strands in a sequence design response, or None if they are not of the expected form."""
+    if condition == "naive":
+        ans_string = out_string.split(" ")
+    elif "CoT" in condition and "ans:" in out_string:
+        ans_string = out_string.split("ans:")[1]
+        ans_string = ans_string.split(" ")
+    else:
+        return None
+    if len(ans_string) == 2 and len(ans_string[0]) == len(ans_string[1]) == (len(dotpar)-1)/2 and all(all(char in 'GCTA' for char in string) for string in ans_string):
+        return ans_string
+    return None
+
+
+def reverse_complement_result(sample):
+    seq1, seq2, mfe, prob_string, dotpar = sample
+    return {        "seq1": seq1,
+                    "seq2": seq2,
+                    "MFE": mfe,
+                    "structure": dotpar,
+                    "prob_string": prob_string,
+                    "rev2": reverse_complement(seq2),
+                }            
+
+
+def secondary_structure_result(sample):
+    seq1, seq2, mfe, prob_string, dotpar = sample
+    rev2 = reverse_complement(seq2)
+    base_compare_string = base_compare(seq1, rev2)
+    return {        "seq1": seq1,
+                    "seq2": seq2,
+                    "MFE": mfe,
+                    "structure": dotpar,
+                    "prob_string": prob_string,
+                    "base_comparison": base_compare_string,
+                }
+
+
+def mfe_result(sample):
+    seq1, seq2, mfe, prob_string, dotpar = sample
+    return {
+        "seq1": seq1,
+        "seq2": seq2,
+        "MFE": mfe,
+        "structure": dotpar,
+        "prob_string": prob_string,                
+    }
+
+
+async def reverse_complement_sample(sample,condition,max_tries,retry_delay,timeout_duration,modelid,n_candidates=1):
+    seq1, seq2, mfe, prob_string, dotpar = sample
+    bad_outputs = 0
+    res_dic = reverse_complement_result(sample)
+    message = reverse_complement_message(seq2)
+    validate = lambda out_string: parse_reverse_complement(out_string,condition,seq2)
+    prefix_ok = lambda prefix: stream_prefix_ok(prefix,condition == "CoT",'GCTA',len(seq2),max_trace_length(len(seq2)),ends_at_ans=True)
+    while True:
+        n = min(n_candidates,max_tries-bad_outputs)
+        response = await call_openai_api(message,timeout_duration,modelid,validate=validate,attempt=bad_outputs,n=n,prefix_ok=prefix_ok,stage="reverse_complement")
+        if response is not None: #in case of API timeout
+            for out_string in response_candidates(response):
+                ans_string = validate(out_string)
+                if ans_string is not None: #verify correct output form
+                    res_dic["model"] = ans_string
+                    return res_dic
+                bad_outputs+=1
+                if bad_outputs == max_tries:
+                    res_dic["model"] = "2"
+                    return res_dic
+        else:
+            print("timeout, retrying")
+            await asyncio.sleep(retry_delay)
+
+
+async def secondary_structure_sample(sample,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=None,n_candidates=1,model_rev2=None):
+    seq1, seq2, mfe, prob_string, dotpar = sample
+    bad_outputs = 0
+    rev2 = reverse_complement(seq2)
+    res_dic = secondary_structure_result(sample)
+    if "+rev_comp_expert+CoT" in condition:
+        if model_rev2 is None: # not already answered by an earlier pipeline stage
+            rev_comp_res = await reverse_complement_sample(sample,"naive",coe_args["max_tries"],retry_delay,timeout_duration,coe_args["modelid_rev_comp"],n_candidates=n_candidates)
+            model_rev2 = rev_comp_res["model"]
+        message = secondary_structure_message(condition,seq1,seq2,model_rev2)
+    else:
+        message = secondary_structure_message(condition,seq1,seq2,rev2)
+    validate = lambda out_string: parse_secondary_structure(out_string,condition,seq1,seq2)
+    prefix_ok = lambda prefix: stream_prefix_ok(prefix,"CoT" in condition,'().+',len(seq1)+len(seq2)+1,max_trace_length(len(seq1)))
+    while True:
+        n = min(n_candidates,max_tries-bad_outputs)
+        response = await call_openai_api(message,timeout_duration,modelid,validate=validate,attempt=bad_outputs,n=n,prefix_ok=prefix_ok,stage="secondary_structure")
+        if response is not None: #in case of API timeout
+            for out_string in response_candidates(response):
+                ans_string = validate(out_string)
+                if ans_string is not None:
+                    res_dic.update({"model_structure": ans_string})
+                    if condition == "+rev_comp_expert+CoT":
+                        res_dic.update({"model_rev2": model_rev2})
+                    return res_dic
+                bad_outputs+=1
+                if bad_outputs == max_tries:
+                    res_dic.update({"model_structure": "2"})
+                    if condition == "+rev_comp_expert+CoT":
+                        res_dic.update({"model_rev2": model_rev2})
+                    return res_dic
+        else:
+            print("timeout, retrying")
+            await asyncio.sleep(retry_delay)
+
+
+async def mfe_sample(sample,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=None,n_candidates=1,model_rev2=None):
+    seq1, seq2, mfe, prob_string, dotpar = sample
+    bad_outputs = 0
+    rev2 = reverse_complement(seq2)
+    res_dic = mfe_result(sample)
+    if "+rev_comp_expert+CoT" in condition:
+        if model_rev2 is None: # not already answered by an earlier pipeline stage
+            rev_comp_res = await reverse_complement_sample(sample,"naive",coe_args["max_tries"],retry_delay,timeout_duration,coe_args["modelid_rev_comp"],n_candidates=n_candidates)
+            model_rev2 = rev_comp_res["model"]                
+        message = mfe_message(condition,seq1,seq2,model_rev2,dotpar)
+    else:
+        message = mfe_message(condition,seq1,seq2,rev2,dotpar)
+    validate = lambda out_string: parse_mfe(out_string,condition)
+    prefix_ok = lambda prefix: mfe_prefix_ok(prefix,"CoT" in condition,max_trace_length(len(seq1)))
+    while True:
+        n = min(n_candidates,max_tries-bad_outputs)
+        response = await call_openai_api(message,timeout_duration,modelid,validate=validate,attempt=bad_outputs,n=n,prefix_ok=prefix_ok,stage="minimum_free_energy")
+        if response is not None: #in case of API timeout
+            for out_string in response_candidates(response):
+                ans_string = validate(out_string)
+                if ans_string is not None:
+                    res_dic.update({"model_MFE": ans_string })
+                    if condition =="+rev_comp_expert+CoT":
+                        res_dic.update({"model_rev2": model_rev2})
+                    return res_dic
+                bad_outputs+=1
+                if bad_outputs == max_tries:
+                    res_dic.update({"model_MFE": "2" })
+                    if condition =="+rev_comp_expert+CoT":
+                        res_dic.update({"model_rev2": "2"})                            
+                    return res_dic
+        else:
+            print("timeout, retrying")
+            await asyncio.sleep(retry_delay)
+
+
+async def sequence_sample(structure,condition,max_tries,retry_delay,timeout_duration,modelid,nupack_pool,nupack_cache,coe_args=None,n_candidates=1):
+    dotpar, _, _ = structure
     if coe_args:
         max_tries_rev_comp = coe_args["max_tries"]        
         if "+rev_comp_expert" in condition:
             modelid_rev_comp = coe_args["modelid_rev_comp"]
         if "+error_checking_expert+" in condition:
             modelid_dotpar = coe_args["modelid_dotpar"]
-
-    nupackmodel = nup.Model(material='DNA',celsius=20)      
-    results = []
-    with tqdm(total=len(structures)) as pbar: 
-        for dotpar,_,_ in structures:
-            bad_outputs = 0
-
-            message = [{"role": "system", "content": "You are a DNA designer. Please design a pair of DNA sequences that will form the following secondary structure."},
-            {"role": "user", "content": f"{dotpar}"}]
-            while True:
-                response = call_openai_api(message,timeout_duration,modelid)
-                valid_out = False
-                if response is not None: #in case of API timeout
-                    out_string = str(response.choices[0].message.content)
-                    if condition == "naive":
-                        ans_string = out_string.split(" ")
-                        valid_out = len(ans_string) == 2 and len(ans_string[0]) == len(ans_string[1]) == (len(dotpar)-1)/2 and all(all(char in 'GCTA' for char in string) for string in ans_string)
-                    elif "CoT" in condition and "ans:" in out_string:
-                        ans_string = out_string.split("ans:")[1]
-                        ans_string = ans_string.split(" ")
-                        valid_out = len(ans_string) == 2 and len(ans_string[0]) == len(ans_string[1]) == (len(dotpar)-1)/2 and all(all(char in 'GCTA' for char in string) for string in ans_string)
-                    if valid_out:
-                        model_seq1 = ans_string[0]
-                        if condition == "CoTrev2+rev_comp":
-                            model_seq2 = reverse_complement(ans_string[1])
-                        elif "CoTrev2+rev_comp_expert" in condition and "+error_checking+" not in condition:
-                            rev_comp_res = test_reverse_complement_model([("2", ans_string[1], "2", "2", "2")],"naive",max_tries_rev_comp,retry_delay,timeout_duration,modelid_rev_comp)
-                            model_seq2 = rev_comp_res[0]["model"]
-                            if model_seq2 == "2":
+    bad_outputs = 0
+    message = sequence_message(dotpar)
+    validate = lambda out_string: parse_sequence(out_string,condition,dotpar)
+    seq_length = (len(dotpar)-1)//2
+    prefix_ok = lambda prefix: stream_prefix_ok(prefix,"CoT" in condition,'GCTA ',2*seq_length+1,max_trace_length(seq_length),ends_at_ans=True)
+    while True:
+        n = min(n_candidates,max_tries-bad_outputs)
+        response = await call_openai_api(message,timeout_duration,modelid,validate=validate,attempt=bad_outputs,n=n,prefix_ok=prefix_ok,stage="sequence_design")
+        if response is not None: #in case of API timeout
+            for out_string in response_candidates(response):
+                ans_string = validate(out_string)
+                valid_out = ans_string is not None
+                if valid_out:
+                    model_seq1 = ans_string[0]
+                    if condition == "CoTrev2+rev_comp":
+                        model_seq2 = reverse_complement(ans_string[1])
+                    elif "CoTrev2+rev_comp_expert" in condition and "+error_checking+" not in condition:
+                        rev_comp_res = await reverse_complement_sample(("2", ans_string[1], "2", "2", "2"),"naive",max_tries_rev_comp,retry_delay,timeout_duration,modelid_rev_comp,n_candidates=n_candidates)
+                        model_seq2 = rev_comp_res["model"]
+                        if model_seq2 == "2":
+                            valid_out = False
+                    elif condition == "CoTseq2" or condition == "naive":
+                        model_seq2 = ans_string[1]
+                
+                if valid_out and "+error_checking+" in condition:
+                    model_dotpar = await verify_design(model_seq1,model_seq2,nupack_pool,nupack_cache)
+                    valid_out = model_dotpar == dotpar
+                
+                elif valid_out and "+error_checking_expert+" in condition:
+                        dotpar_res = await secondary_structure_sample((model_seq1, ans_string[1], "2", "2", dotpar),"CoT_error_check",max_tries_rev_comp,retry_delay,timeout_duration,modelid_dotpar,n_candidates=n_candidates)
+                        expert_dotpar = dotpar_res["model_structure"]
+                        valid_out =  expert_dotpar == dotpar
+                        if valid_out:
+                            rev_comp_res = await reverse_complement_sample(("2", ans_string[1], "2", "2", "2"),"naive",max_tries_rev_comp,retry_delay,timeout_duration,modelid_rev_comp,n_candidates=n_candidates)
+                            model_seq2 = rev_comp_res["model"]
+                            if valid_out and model_seq2 !="2":
+                                model_dotpar = await verify_design(model_seq1,model_seq2,nupack_pool,nupack_cache)                                                       
+                            else:
                                 valid_out = False
-                        elif valid_out and (condition == "CoTseq2" or condition == "naive"):
-                            model_seq2 = ans_string[1]
-                    
-                    if valid_out and "+error_checking+" in condition:
-                        model_dotpar = structure_from_strands(model_seq1,model_seq2,nupackmodel)
-                        valid_out = model_dotpar == dotpar
-                    
-                    elif valid_out and "+error_checking_expert+" in condition:
-                            dotpar_res = test_secondary_structure_model([(model_seq1, ans_string[1], "2", "2", dotpar)],"CoT_error_check",max_tries_rev_comp,retry_delay,timeout_duration,modelid_dotpar)
-                            expert_dotpar = dotpar_res[0]["model_structure"]
-                            valid_out =  expert_dotpar == dotpar
-                            if valid_out:
-                                rev_comp_res = test_reverse_complement_model([("2", ans_string[1], "2", "2", "2")],"naive",max_tries_rev_comp,retry_delay,timeout_duration,modelid_rev_comp)
-                                model_seq2 = rev_comp_res[0]["model"]
-                                if valid_out and model_seq2 !="2":
-                                    model_dotpar = structure_from_strands(model_seq1,model_seq2,nupackmodel)                                                       
-                                else:
-                                    valid_out = False
-                            
-
-                    if valid_out:
-                        if "error_checking" not in condition:
-                            model_dotpar = structure_from_strands(model_seq1,model_seq2,nupackmodel)
+                        
+
+                if valid_out:
+                    if "error_checking" not in condition:
+                        model_dotpar = await verify_design(model_seq1,model_seq2,nupack_pool,nupack_cache)
+                    res_dic={
+                    "structure": dotpar,
+                    "model_structure": model_dotpar,
+                    "model_seq1": model_seq1,
+                    "model_seq2": model_seq2                                 
+                    }
+                    if "+error_checking_expert+" in condition:
+                        res_dic["expert_dotpar"] = expert_dotpar
+                    return res_dic
+                else:
+                    bad_outputs+=1
+                    if bad_outputs == max_tries:
                         res_dic={
                         "structure": dotpar,
-                        "model_structure": model_dotpar,
-                        "model_seq1": model_seq1,
-                        "model_seq2": model_seq2                                 
+                        "model_structure": "2",
+                        "model_seq1": "2",
+                        "model_seq2": "2"                                 
                         }
                         if "+error_checking_expert+" in condition:
-                            res_dic["expert_dotpar"] = expert_dotpar
-                        results.append(res_dic)
-                        break
-                    else:
-                        bad_outputs+=1
-                        if bad_outputs == max_tries:
-                            res_dic={
-                            "structure": dotpar,
-                            "model_structure": "2",
-                            "model_seq1": "2",
-                            "model_seq2": "2"                                 
-                            }
-                            if "+error_checking_expert+" in condition:
-                                res_dic["expert_dotpar"] = "2"
-                            results.append(res_dic)
-                            break
-                else:
-                    print("timeout, retrying")
-                    time.sleep(retry_delay)
-            pbar.update(1)                    
+                            res_dic["expert_dotpar"] = "2"
+                        return res_dic
+        else:
+            print("timeout, retrying")
+            await asyncio.sleep(retry_delay)
+
+
+async def test_reverse_complement_model(sampled_sequences,condition,max_tries,retry_delay,timeout_duration,modelid,concurrency=1,on_result=None,n_candidates=1):
+    return await run_samples(reverse_complement_sample,sampled_sequences,concurrency,condition,max_tries,retry_delay,timeout_duration,modelid,leave=False,on_result=on_result,n_candidates=n_candidates)
+
+
+async def test_secondary_structure_model(sampled_sequences,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=None,concurrency=1,on_result=None,n_candidates=1):
+    return await run_samples(secondary_structure_sample,sampled_sequences,concurrency,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=coe_args,leave=False,on_result=on_result,n_candidates=n_candidates)
+
+
+async def test_mfe_model(sampled_sequences,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=None,concurrency=1,on_result=None,n_candidates=1):
+    return await run_samples(mfe_sample,sampled_sequences,concurrency,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=coe_args,on_result=on_result,n_candidates=n_candidates)
+
+
+async def test_sequence_model(structures,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=None,concurrency=1,on_result=None,n_candidates=1,verify_workers=None,nupack_pool=None):
+    nupack_cache = ComplexAnalysisCache(NUPACK_CACHE_PATH, material='DNA', celsius=20)
+    if nupack_pool is not None: # shared with the other models of a multi-model run
+        results = await run_samples(sequence_sample,structures,concurrency,condition,max_tries,retry_delay,timeout_duration,modelid,nupack_pool,nupack_cache,coe_args=coe_args,on_result=on_result,n_candidates=n_candidates)
+    else:
+        with analysis_pool(verify_workers, material='DNA', celsius=20) as nupack_pool:
+            results = await run_samples(sequence_sample,structures,concurrency,condition,max_tries,retry_delay,timeout_duration,modelid,nupack_pool,nupack_cache,coe_args=coe_args,on_result=on_result,n_candidates=n_candidates)
+    print(f"NUPACK cache: {nupack_cache.stats()}")
+    nupack_cache.close()
     return results    
                             
 
-def analyze_model(experiment,condition, train_size, max_tries, modelid=None, coe_args=None):
-    retry_delay = 5  # Delay in seconds between retries
-    timeout_duration = 180  # Timeout in seconds for each API call
+def is_pipeline_condition(experiment, condition):
+    """Expert conditions that can be run as a pipeline of stages."""
+    if experiment in ("secondary_structure", "minimum_free_energy"):
+        return "+rev_comp_expert+CoT" in condition
+    if experiment == "sequence_design":
+        return "CoTrev2+rev_comp_expert" in condition and "+error_checking+" not in condition
+    return False
+
 
+async def test_expert_pipeline(experiment,samples,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args,concurrency=1,on_result=None,n_candidates=1,verify_workers=None,nupack_pool=None):
+    """Run an expert condition as a stage graph instead of one chained coroutine per sample.
+
+    Each stage (designer, reverse complement expert, structure expert, NUPACK check on the process
+    pool) has its own pool of workers, so e.g. the reverse complement expert works on one sample while the structure
+    expert works on another. The stages make the same calls and keep the same retry accounting as
+    the per-sample functions.
+    """
+    max_tries_rev_comp = coe_args["max_tries"]
+
+    async def rev_comp_expert_stage(state):
+        rev_comp_res = await reverse_complement_sample(state["sample"],"naive",max_tries_rev_comp,retry_delay,timeout_duration,coe_args["modelid_rev_comp"],n_candidates=n_candidates)
+        state["model_rev2"] = rev_comp_res["model"]
+        return "predict"
+
+    async def structure_stage(state):
+        state["result"] = await secondary_structure_sample(state["sample"],condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=coe_args,n_candidates=n_candidates,model_rev2=state["model_rev2"])
+
+    async def mfe_stage(state):
+        state["result"] = await mfe_sample(state["sample"],condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=coe_args,n_candidates=n_candidates,model_rev2=state["model_rev2"])
+
+    def reject_design(state):
+        state["bad_outputs"] += 1
+        if state["bad_outputs"] == max_tries:
+            state["result"] = {"structure": state["dotpar"], "model_structure": "2", "model_seq1": "2", "model_seq2": "2"}
+            if "+error_checking_expert+" in condition:
+                state["result"]["expert_dotpar"] = "2"
+            return None
+        return "design"
+
+    async def design_stage(state):
+        dotpar = state["dotpar"]
+        if not state["candidates"]:
+            seq_length = (len(dotpar)-1)//2
+            prefix_ok = lambda prefix: stream_prefix_ok(prefix,"CoT" in condition,'GCTA ',2*seq_length+1,max_trace_length(seq_length),ends_at_ans=True)
+            n = min(n_candidates,max_tries-state["bad_outputs"])
+            response = await call_openai_api(sequence_message(dotpar),timeout_duration,modelid,validate=state["validate"],attempt=state["bad_outputs"],n=n,prefix_ok=prefix_ok,stage="sequence_design")
+            if response is None:
+                print("timeout, retrying")
+                await asyncio.sleep(retry_delay)
+                return "design"
+            state["candidates"] = response_candidates(response)
+        ans_string = state["validate"](state["candidates"].pop(0))
+        if ans_string is None:
+            return reject_design(state)
+        state["ans_string"] = ans_string
+        state["expert_checked"] = False
+        return "rev_comp_expert"
+
+    async def design_rev_comp_stage(state):
+        rev_comp_res = await reverse_complement_sample(("2", state["ans_string"][1], "2", "2", "2"),"naive",max_tries_rev_comp,retry_delay,timeout_duration,coe_args["modelid_rev_comp"],n_candidates=n_candidates)
+        state["model_seq2"] = rev_comp_res["model"]
+        if state["model_seq2"] == "2":
+            return reject_design(state)
+        if "+error_checking_expert+" in condition and not state["expert_checked"]:
+            return "dotpar_expert"
+        return "verify"
+
+    async def dotpar_expert_stage(state):
+        dotpar = state["dotpar"]
+        dotpar_res = await secondary_structure_sample((state["ans_string"][0], state["ans_string"][1], "2", "2", dotpar),"CoT_error_check",max_tries_rev_comp,retry_delay,timeout_duration,coe_args["modelid_dotpar"],n_candidates=n_candidates)
+        state["expert_dotpar"] = dotpar_res["model_structure"]
+        if state["expert_dotpar"] != dotpar:
+            return reject_design(state)
+        # as in sequence_sample, the strand used is the reverse complement expert's answer after the check
+        state["expert_checked"] = True
+        return "rev_comp_expert"
+
+    async def verify_stage(state):
+        model_seq1 = state["ans_string"][0]
+        model_dotpar = await verify_design(model_seq1,state["model_seq2"],nupack_pool,nupack_cache)
+        state["result"] = {"structure": state["dotpar"], "model_structure": model_dotpar, "model_seq1": model_seq1, "model_seq2": state["model_seq2"]}
+        if "+error_checking_expert+" in condition:
+            state["result"]["expert_dotpar"] = state["expert_dotpar"]
+
+    own_pool = experiment == "sequence_design" and nupack_pool is None
     if experiment == "sequence_design":
-        with open(f"training_data/structure_validation_set.json", 'r') as f:
-            val_set = json.load(f)        
-    else:    
-        with open(f"training_data/sequence_validation_set.json", 'r') as f:
-            val_set = json.load(f)
+        verify_workers = verify_workers or os.cpu_count()
+        if own_pool:
+            nupack_pool = analysis_pool(verify_workers, material='DNA', celsius=20)
+        nupack_cache = ComplexAnalysisCache(NUPACK_CACHE_PATH, material='DNA', celsius=20)
+        stages = [Stage("design",design_stage,concurrency),
+                  Stage("rev_comp_expert",design_rev_comp_stage,concurrency),
+                  Stage("dotpar_expert",dotpar_expert_stage,concurrency),
+                  Stage("verify",verify_stage,verify_workers)]
+        states = [{"dotpar": dotpar, "bad_outputs": 0, "candidates": [],
+                   "validate": lambda out_string, dotpar=dotpar: parse_sequence(out_string,condition,dotpar)} for dotpar, _, _ in samples]
+        entry = "design"
+    else:
+        predict_stage = structure_stage if experiment == "secondary_structure" else mfe_stage
+        stages = [Stage("rev_comp_expert",rev_comp_expert_stage,concurrency), Stage("predict",predict_stage,concurrency)]
+        states = [{"sample": sample} for sample in samples]
+        entry = "rev_comp_expert"
+
+    # stage workers handle many samples, so each handler call makes its sample's telemetry current
+    def with_telemetry(handler):
+        async def run(state):
+            telemetry.start_sample(state["telemetry"])
+            return await handler(state)
+        return run
+    for stage in stages:
+        stage.handler = with_telemetry(stage.handler)
+    for state in states:
+        state["telemetry"] = telemetry.SampleTelemetry()
+    telemetry_log = telemetry.current_log.get()
+
+    with tqdm(total=len(samples)) as pbar:
+        def finish(indx, res_dic):
+            pbar.update(1)
+            if telemetry_log is not None:
+                telemetry_log.write(indx,states[indx]["telemetry"])
+            if on_result is not None:
+                on_result(indx,res_dic)
+        results = await run_pipeline(stages,entry,states,on_result=finish)
+    if own_pool:
+        nupack_pool.shutdown()
+    if experiment == "sequence_design":
+        print(f"NUPACK cache: {nupack_cache.stats()}")
+        nupack_cache.close()
+    return results
 
-    print("starting analysis")
-    if experiment == "reverse_complement":
-        responses = test_reverse_complement_model(val_set,condition,max_tries,retry_delay,timeout_duration,modelid)
-    elif experiment == "secondary_structure":
-        responses = test_secondary_structure_model(val_set,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=coe_args)
-    elif experiment == "minimum_free_energy":
-        responses = test_mfe_model(val_set,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=coe_args)
-    elif experiment == "sequence_design":
-        responses = test_sequence_model(val_set,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=coe_args)
 
+def load_validation_set(experiment):
+    # training_data/*.col (see columnar_dataset.py) is used instead of the JSON file when present
+    if experiment == "sequence_design":
+        return load_dataset("structure_validation_set")
+    return load_dataset("sequence_validation_set")
+
+
+def results_filename(experiment, condition, max_tries, train_size):
     if condition is not None:
-        val_model_out_filename = f"test_results/{experiment}_{condition}_max_tries_{max_tries}_test_size_{train_size}.json"
-    else:
-        val_model_out_filename = f"test_results/{experiment}_max_tries_{max_tries}_test_size_{train_size}.json"
+        return f"test_results/{experiment}_{condition}_max_tries_{max_tries}_test_size_{train_size}.json"
+    return f"test_results/{experiment}_max_tries_{max_tries}_test_size_{train_size}.json"
+
+
+def shard_bounds(n_samples, shard_index, shard_count):
+    """Start and end of the contiguous slice of the validation set evaluated by one shard."""
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"shard index {shard_index} is not in 0..{shard_count-1}")
+    return n_samples*shard_index//shard_count, n_samples*(shard_index+1)//shard_count
+
+
+def shard_filename(filename, shard_index, shard_count):
+    """e.g. test_results/x_test_size_500_shard_0_of_4.json for shard 0 of 4 of test_results/x_test_size_500.json."""
+    return filename[:-len(".json")] + f"_shard_{shard_index}_of_{shard_count}.json"
+
+
+async def evaluate_model(experiment,condition,train_size,max_tries,modelid,val_set,coe_args=None,concurrency=1,resume=False,n_candidates=1,pipelined=False,nupack_pool=None,shard=None,verify_workers=None):
+    """Evaluate one model on val_set and write its results file; several can run on one event loop.
+
+    shard=(index, count) evaluates only that contiguous slice of val_set and writes it to a shard
+    file, to be combined with the other shards by merge_shards.py.
+    """
+    retry_delay = 5  # Delay in seconds between retries
+    timeout_duration = 180  # Timeout in seconds for each API call
+
+    val_model_out_filename = results_filename(experiment,condition,max_tries,train_size)
+    if shard is not None:
+        start, end = shard_bounds(len(val_set),*shard)
+        val_set = val_set[start:end]
+        val_model_out_filename = shard_filename(val_model_out_filename,*shard)
+        print(f"shard {shard[0]} of {shard[1]}: validation samples {start} to {end-1}")
+
+    # Results are appended to the output file as samples finish; with resume=True the samples
+    # already in an existing partial file are skipped and the rest are appended to it.
+    completed = 0
+    if resume and os.path.exists(val_model_out_filename):
+        completed = read_completed_results(val_model_out_filename,val_set,experiment)
+        print(f"resuming after {completed} completed samples")
+    remaining = val_set[completed:]
+
+    # per-sample calls, retries, tokens and seconds go to a sidecar file next to the results
+    telemetry_log = telemetry.TelemetryLog(telemetry.telemetry_filename(val_model_out_filename),offset=completed)
+    telemetry.current_log.set(telemetry_log)
 
-    # Write the results to a JSON file
-    with open(val_model_out_filename, 'w') as f:
-        for item in responses:
-            f.write(json.dumps(item) + '\n')
+    print("starting analysis")
+    with open(val_model_out_filename, 'a' if completed else 'w') as f:
+        writer = OrderedResultWriter(f)
+        if pipelined and is_pipeline_condition(experiment,condition):
+            await test_expert_pipeline(experiment,remaining,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args,concurrency=concurrency,on_result=writer.write,n_candidates=n_candidates,verify_workers=verify_workers,nupack_pool=nupack_pool)
+        elif experiment == "reverse_complement":
+            await test_reverse_complement_model(remaining,condition,max_tries,retry_delay,timeout_duration,modelid,concurrency=concurrency,on_result=writer.write,n_candidates=n_candidates)
+        elif experiment == "secondary_structure":
+            await test_secondary_structure_model(remaining,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=coe_args,concurrency=concurrency,on_result=writer.write,n_candidates=n_candidates)
+        elif experiment == "minimum_free_energy":
+            await test_mfe_model(remaining,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=coe_args,concurrency=concurrency,on_result=writer.write,n_candidates=n_candidates)
+        elif experiment == "sequence_design":
+            await test_sequence_model(remaining,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=coe_args,concurrency=concurrency,on_result=writer.write,n_candidates=n_candidates,verify_workers=verify_workers,nupack_pool=nupack_pool)
+    telemetry_log.close()
+
+
+def print_run_stats():
+    print(f"Rate limiter: {openai_client.get_limiter().stats()}")
+    for hedge_modelid, policy in hedge_policies.items():
+        print(f"Hedging {hedge_modelid}: {policy.stats()}")
+    if response_cache is not None:
+        print(f"Response cache: {response_cache.stats()}")
+
+
+def analyze_model(experiment,condition, train_size, max_tries, modelid=None, coe_args=None, concurrency=1, batch=False, resume=False, n_candidates=1, pipelined=False, sequential=None, shard_index=None, shard_count=None, verify_workers=None):
+    shard = (shard_index, shard_count) if shard_count is not None else None
+    if shard is not None and (batch or sequential is not None):
+        raise ValueError("sharded evaluation cannot be combined with batch or sequential evaluation")
+    if batch:
+        from batch_eval import analyze_model_batch
+        analyze_model_batch(experiment,condition,train_size,max_tries,modelid)
+        return
+    if sequential is not None:
+        # e.g. sequential={"target_width": 0.05} or {"baseline": "test_results/..._test_size_{train_size}.json"}
+        from sequential_eval import analyze_model_sequential
+        analyze_model_sequential(experiment,condition,train_size,max_tries,modelid,coe_args=coe_args,concurrency=concurrency,n_candidates=n_candidates,verify_workers=verify_workers,**sequential)
+        print_run_stats()
+        return
+
+    val_set = load_validation_set(experiment)
+    run_async(evaluate_model(experiment,condition,train_size,max_tries,modelid,val_set,coe_args=coe_args,concurrency=concurrency,resume=resume,n_candidates=n_candidates,pipelined=pipelined,shard=shard,verify_workers=verify_workers))
+    print_run_stats()
 
     # responses = []
     # with open(val_model_out_filename,'r') as f:
@@ -366,11 +786,15 @@ def analyze_model(experiment,condition, train_size, max_tries, modelid=None, coe
     #     # print(bad_out/total_count*100)
 
 
-def performance_test(experiment,max_tries,condition=None):
-    if (experiment == "secondary_structure" and "+rev_comp_expert+CoT" in condition) or \
+def is_expert_condition(experiment, condition):
+    return (experiment == "secondary_structure" and "+rev_comp_expert+CoT" in condition) or \
         (experiment == "minimum_free_energy" and "+rev_comp_expert+CoT" in condition) or \
-        (experiment == "sequence_design" and "CoTrev2+rev_comp_expert" in condition):
+        (experiment == "sequence_design" and "CoTrev2+rev_comp_expert" in condition)
+
 
+def model_runs(experiment, condition):
+    """Return (train_size, modelid, coe_args) for every model of a condition, reading each model_ids file once."""
+    if condition is not None and is_expert_condition(experiment,condition):
         substrings = ["+rev_comp_expert+CoT","+rev_comp_expert+CoT","CoTrev2+rev_comp_expert"]
         for subs in substrings:
             if subs in condition:
@@ -378,38 +802,93 @@ def performance_test(experiment,max_tries,condition=None):
                 break
         with open(f"model_ids/{experiment}_{subcondition}_models.json",'r') as f:
             model_list = json.load(f)
-        
+        with open("model_ids/reverse_complement_naive_models.json",'r') as f:
+            rev_comp_models = json.load(f)
+        if "+error_checking_expert+" in condition:
+            with open("model_ids/secondary_structure_+rev_comp+CoT_models.json",'r') as f:
+                dotpar_models = json.load(f)
+
+        runs = []
         for indx, (train_size, modelid) in enumerate(model_list):
             coe_args = {}
-            with open("model_ids/reverse_complement_naive_models.json",'r') as f:
-                ts, coe_args["modelid_rev_comp"] = json.load(f)[indx]
+            ts, coe_args["modelid_rev_comp"] = rev_comp_models[indx]
             if ts != train_size:
                 raise ValueError("training sizes are not equal!")
             if "+error_checking_expert+" in condition:
-                with open("model_ids/secondary_structure_+rev_comp+CoT_models.json",'r') as f:
-                    ts, coe_args["modelid_dotpar"] = json.load(f)[indx]
+                ts, coe_args["modelid_dotpar"] = dotpar_models[indx]
                 if ts != train_size:
                     raise ValueError("training sizes are not equal!")                 
 
             match = re.search(r'\d+$', condition)
             coe_args["max_tries"] = int(match.group())
             if train_size > 1401:
-                analyze_model(experiment,condition,train_size,max_tries,modelid=modelid,coe_args=coe_args)
-    else:        
-        if condition is not None:
-            file_name =  f"model_ids/{experiment}_{condition}_models.json"
-        else:
-            file_name =  f"model_ids/{experiment}_models.json"
+                runs.append((train_size, modelid, coe_args))
+        return runs
 
-        with open(file_name,'r') as f:
-            model_list = json.load(f) 
-        for ts, model_id in model_list:
-            analyze_model(experiment,condition,ts,max_tries, modelid=model_id)
+    if condition is not None:
+        file_name =  f"model_ids/{experiment}_{condition}_models.json"
+    else:
+        file_name =  f"model_ids/{experiment}_models.json"
+    with open(file_name,'r') as f:
+        model_list = json.load(f) 
+    return [(ts, model_id, None) for ts, model_id in model_list]
+
+
+async def evaluate_models(experiment,condition,max_tries,runs,concurrency=1,resume=False,n_candidates=1,pipelined=False,shard=None,verify_workers=None):
+    """Evaluate every model of a condition at once, each writing its own results file.
+
+    The validation set is loaded once. The models share the rate limiter, one pool of `concurrency`
+    sample slots (pipelines keep per-model stage workers and are bounded by the limiter) and, in
+    sequence design, one NUPACK process pool.
+    """
+    val_set = load_validation_set(experiment)
+    use_pipeline = pipelined and is_pipeline_condition(experiment,condition)
+    sample_slots = concurrency if use_pipeline else asyncio.Semaphore(concurrency)
+    nupack_pool = analysis_pool(verify_workers or os.cpu_count(), material='DNA', celsius=20) if experiment == "sequence_design" else None
+    try:
+        await asyncio.gather(*(evaluate_model(experiment,condition,train_size,max_tries,modelid,val_set,coe_args=coe_args,concurrency=sample_slots,resume=resume,n_candidates=n_candidates,pipelined=pipelined,nupack_pool=nupack_pool,shard=shard)
+                               for train_size, modelid, coe_args in runs))
+    finally:
+        if nupack_pool is not None:
+            nupack_pool.shutdown()
+
+
+def performance_test(experiment,max_tries,condition=None,concurrency=1,max_in_flight=None,response_cache_mode=None,batch=False,resume=False,n_candidates=1,stream=False,pipelined=False,rpm=None,tpm=None,hedge=None,multi_model=False,sequential=None,shard_index=None,shard_count=None,verify_workers=None):
+    global response_cache, stream_completions, hedging
+    if batch:
+        from batch_eval import BATCH_CONDITIONS
+        if condition not in BATCH_CONDITIONS[experiment]:
+            raise ValueError(f"batch mode does not support the {experiment} condition {condition}")
+    # e.g. hedge={"percentile": 95, "budget": 0.1}: duplicate requests slower than the 95th percentile, for at most 10% of requests
+    hedging = hedge
+    # latencies and hedge counts are per run
+    hedge_policies.clear()
+    # streamed responses are dropped as soon as they can no longer pass validation
+    stream_completions = stream
+    # all samples and their nested expert calls share the client's rate limiter
+    openai_client.configure(connections=max_in_flight,in_flight=max_in_flight,rpm=rpm,tpm=tpm)
+    # a run only uses the response cache it asks for, never one left over from an earlier call
+    if response_cache is not None:
+        response_cache.close()
+    response_cache = ResponseCache(RESPONSE_CACHE_PATH,mode=response_cache_mode) if response_cache_mode is not None else None
+    runs = model_runs(experiment,condition)
+    if multi_model and not batch and sequential is None:
+        # all train-size models of the condition are evaluated at once
+        shard = (shard_index, shard_count) if shard_count is not None else None
+        run_async(evaluate_models(experiment,condition,max_tries,runs,concurrency=concurrency,resume=resume,n_candidates=n_candidates,pipelined=pipelined,shard=shard,verify_workers=verify_workers))
+        print_run_stats()
+        return
+    for train_size, modelid, coe_args in runs:
+        if coe_args is not None:
+            analyze_model(experiment,condition,train_size,max_tries,modelid=modelid,coe_args=coe_args,concurrency=concurrency,resume=resume,n_candidates=n_candidates,pipelined=pipelined,sequential=sequential,shard_index=shard_index,shard_count=shard_count,verify_workers=verify_workers)
+        else:
+            analyze_model(experiment,condition,train_size,max_tries, modelid=modelid,concurrency=concurrency,batch=batch,resume=resume,n_candidates=n_candidates,sequential=sequential,shard_index=shard_index,shard_count=shard_count,verify_workers=verify_workers)
 
 
 if __name__ == '__main__':
     experiment = "sequence_design"
     condition = "+CoTrev2+rev_comp_expert+error_checking_expert+_expert_tries_3"
     max_tries = 3
-    performance_test(experiment,max_tries,condition=condition,)
+    concurrency = 32 # number of validation samples evaluated at once
+    performance_test(experiment,max_tries,condition=condition,concurrency=concurrency)
     # performance_test(experiment,max_tries)
\ No newline at end of file
@@ -0,0 +1,64 @@
+import asyncio
+
+
+class Stage:
+    """One step of a pipeline, served by its own pool of workers pulling from its own queue.
+
+    handler(state) is a coroutine that updates the sample's state dict and returns the name of the
+    stage the sample moves to next, or None once the sample is finished and state["result"] is set.
+    Stages may send a sample back to an earlier stage, e.g. to retry after a failed check.
+    """
+
+    def __init__(self, name, handler, workers):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+
+
+async def run_pipeline(stages, entry, states, on_result=None):
+    """Push every state through the stage graph starting at entry and return the results in input order.
+
+    Different samples occupy different stages at the same time, so throughput is set by the
+    slowest stage rather than the sum of all stages. on_result(index, result) is called as soon as
+    each sample finishes.
+    """
+    queues = {stage.name: asyncio.Queue() for stage in stages}
+    results = [None]*len(states)
+    remaining = len(states)
+    finished = asyncio.Event()
+    errors = []
+
+    async def worker(stage):
+        nonlocal remaining
+        while True:
+            indx, state = await queues[stage.name].get()
+            try:
+                next_stage = await stage.handler(state)
+            except Exception as e:
+                errors.append(e)
+                finished.set()
+                return
+            if next_stage is None:
+                results[indx] = state["result"]
+                if on_result is not None:
+                    on_result(indx,state["result"])
+                remaining -= 1
+                if remaining == 0:
+                    finished.set()
+            else:
+                queues[next_stage].put_nowait((indx,state))
+
+    for indx, state in enumerate(states):
+        queues[entry].put_nowait((indx,state))
+    if remaining == 0:
+        return results
+    tasks = [asyncio.create_task(worker(stage)) for stage in stages for _ in range(stage.workers)]
+    try:
+        await finished.wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,185 @@
+import re
+import time
+import random
+import asyncio
+
+
+def parse_duration(value):
+    """Parse a rate-limit reset header such as "20ms", "1.5s" or "6m0s" into seconds."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    return sum(float(amount)*units[unit] for amount, unit in parts)
+
+
+def header_int(headers, name):
+    value = headers.get(name)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    """Budget of `capacity` units per minute, refilled continuously. A capacity of None is unlimited."""
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated)*self.capacity/60)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount can be taken; requests larger than the bucket only need a full bucket."""
+        if self.capacity is None:
+            return 0.0
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level)*60/self.capacity
+
+    def take(self, amount):
+        if self.capacity is not None:
+            self.level -= amount
+
+    def observe(self, limit, remaining):
+        """Align the bucket with the limit and remaining budget reported by the API."""
+        if limit is not None and limit != self.capacity:
+            self.refill()
+            self.level = limit if self.capacity is None else self.level*limit/self.capacity
+            self.capacity = limit
+        if remaining is not None and self.capacity is not None:
+            self.refill()
+            self.level = min(self.level, remaining)
+
+
+class RateLimiter:
+    """Shared pacing for every chat completion: request and token budgets plus an adaptive concurrency limit.
+
+    Requests wait for a slot under the concurrency limit and for room in the requests-per-minute
+    and tokens-per-minute buckets. The buckets follow the x-ratelimit headers of each response.
+    The concurrency limit grows by one per window of successful requests and is halved on a 429
+    (additive increase, multiplicative decrease), and a 429 pauses all requests until its
+    retry-after time has passed.
+    """
+
+    def __init__(self, max_concurrency=64, rpm=None, tpm=None, min_concurrency=1, decrease_factor=0.5, max_backoff=60):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.decrease_factor = decrease_factor
+        self.max_backoff = max_backoff
+        self.limit = float(max_concurrency)
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.in_flight = 0
+        self.pause_until = 0.0
+        self.last_decrease = 0.0
+        self.completion_tokens = 256.0  # running estimate of completion tokens per candidate
+        self.changed = None
+        self.rate_limited = 0
+        self.completed = 0
+
+    def estimate_tokens(self, message, n=1):
+        prompt_tokens = sum(len(entry["content"]) for entry in message)//4
+        return prompt_tokens + int(n*self.completion_tokens)
+
+    def wake(self):
+        if self.changed is not None:
+            self.changed.set()
+            self.changed = asyncio.Event()
+
+    async def acquire(self, tokens):
+        """Wait until a request estimated at `tokens` tokens may be sent and return its start time."""
+        while True:
+            if self.changed is None:
+                self.changed = asyncio.Event()
+            now = time.monotonic()
+            wait = self.pause_until - now
+            if wait <= 0 and self.in_flight < int(self.limit):
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if wait <= 0:
+                    self.requests.take(1)
+                    self.tokens.take(tokens)
+                    self.in_flight += 1
+                    return now
+            elif wait <= 0:
+                wait = None  # at the concurrency limit, wait for a release
+            changed = self.changed
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def paused(self):
+        """True while all requests are held back after a 429."""
+        return time.monotonic() < self.pause_until
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake()
+
+    def observe_headers(self, headers):
+        self.requests.observe(header_int(headers, "x-ratelimit-limit-requests"), header_int(headers, "x-ratelimit-remaining-requests"))
+        self.tokens.observe(header_int(headers, "x-ratelimit-limit-tokens"), header_int(headers, "x-ratelimit-remaining-tokens"))
+
+    def succeeded(self, headers, tokens, used_tokens=None, completion_tokens=None, n=1):
+        """Record a successful request; used_tokens corrects the token bucket for the estimate made at acquire."""
+        self.completed += 1
+        if used_tokens is not None:
+            self.tokens.take(used_tokens - tokens)
+        if completion_tokens is not None:
+            self.completion_tokens = 0.9*self.completion_tokens + 0.1*completion_tokens/n
+        if headers is not None:
+            self.observe_headers(headers)
+        # additive increase: about one more slot per limit's worth of successful requests
+        self.limit = min(self.max_concurrency, self.limit + 1/self.limit)
+        self.wake()
+
+    def backoff(self, attempt):
+        """Exponential backoff with full jitter for retrying a failed request."""
+        return random.uniform(0, min(self.max_backoff, 2**attempt))
+
+    def throttled(self, started, headers, attempt):
+        """Record a 429 and pause all requests until the API is expected to accept them again."""
+        self.rate_limited += 1
+        now = time.monotonic()
+        if headers is not None:
+            self.observe_headers(headers)
+        # only one decrease per window: 429s for requests sent before the last decrease carry no new information
+        if started >= self.last_decrease:
+            self.limit = max(self.min_concurrency, self.limit*self.decrease_factor)
+            self.last_decrease = now
+        delay = None
+        if headers is not None:
+            delay = parse_duration(headers.get("retry-after-ms"))
+            delay = delay/1000 if delay is not None else parse_duration(headers.get("retry-after"))
+            if delay is None:
+                resets = [parse_duration(headers.get(name)) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")]
+                resets = [reset for reset in resets if reset is not None]
+                delay = min(resets) if resets else None
+        if delay is None:
+            delay = self.backoff(attempt)
+        self.pause_until = max(self.pause_until, now + min(delay, self.max_backoff))
+        self.wake()
+
+    def detach(self):
+        # the wake-up event belongs to the event loop of the run that created it
+        self.changed = None
+        self.in_flight = 0
+
+    def stats(self):
+        return {"completed": self.completed, "rate_limited": self.rate_limited, "concurrency_limit": int(self.limit),
+                "rpm": self.requests.capacity, "tpm": self.tokens.capacity}
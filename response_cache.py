@@ -0,0 +1,62 @@
+import json
+import sqlite3
+import hashlib
+from openai.types.chat import ChatCompletion
+
+RESPONSE_CACHE_PATH = "response_cache.sqlite"
+
+
+class ResponseCache:
+    """Persistent SQLite cache of chat completions keyed by (modelid, messages, sampling params).
+
+    Two modes are supported:
+    - "replay": every response is stored under its attempt number, so a rerun replays the
+      original run attempt by attempt and only goes to the API for attempts never made before.
+    - "first_valid": only responses that pass validation are stored, and only the first attempt
+      of a sample is answered from the cache, so retries after a rejected answer still reach
+      the model.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, mode="first_valid"):
+        if mode not in ("replay", "first_valid"):
+            raise ValueError(f"unknown response cache mode {mode}")
+        self.path = path
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT)")
+        self.conn.commit()
+
+    def key(self, modelid, message, params, attempt):
+        key_fields = [self.mode, modelid, message, params, attempt if self.mode == "replay" else 0]
+        return hashlib.sha256(json.dumps(key_fields, sort_keys=True).encode()).hexdigest()
+
+    def get(self, modelid, message, params, attempt):
+        if self.mode == "first_valid" and attempt > 0:
+            return None
+        row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (self.key(modelid, message, params, attempt),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        response = ChatCompletion.model_validate_json(row[0])
+        if response.usage is not None:
+            self.tokens_saved += response.usage.total_tokens
+        return response
+
+    def put(self, modelid, message, params, attempt, response, valid):
+        if self.mode == "first_valid" and not valid:
+            return
+        self.conn.execute("INSERT OR IGNORE INTO responses VALUES (?, ?)",
+            (self.key(modelid, message, params, attempt), response.model_dump_json()))
+        self.conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits/total if total else 0.0, "tokens_saved": self.tokens_saved}
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,212 @@
+import os
+import json
+import math
+import asyncio
+from statistics import NormalDist
+import numpy as np
+from tqdm import tqdm
+import telemetry
+import performance_test as pt
+from nupack_cache import ComplexAnalysisCache, NUPACK_CACHE_PATH, analysis_pool
+
+# Sequential evaluation with early stopping. Validation samples are drawn in a random order and a
+# running estimate of the accuracy (or, for minimum free energy, the mean absolute error) is kept
+# with a confidence interval. Evaluation stops as soon as the interval is narrower than a target
+# width, or lies entirely above or below the score of a baseline results file. Repeated looks at
+# the interval make it somewhat optimistic, so no decision is taken before min_samples samples.
+
+
+def sample_score(experiment, res_dic):
+    """1/0 for a correct/incorrect answer, or the absolute MFE error in kcal/mol, as in analyze_results.py."""
+    if experiment == "reverse_complement":
+        return float(res_dic["model"] == res_dic["rev2"])
+    elif experiment == "secondary_structure":
+        return float(res_dic["model_structure"] == res_dic["structure"])
+    elif experiment == "minimum_free_energy":
+        return abs(float(res_dic["model_MFE"]) - float(res_dic["MFE"]))
+    elif experiment == "sequence_design":
+        return float(res_dic["model_structure"] == res_dic["structure"])
+
+
+def wilson_interval(successes, n, z):
+    if n == 0:
+        return 0.0, 1.0
+    p = successes/n
+    center = (p + z**2/(2*n))/(1 + z**2/n)
+    half = z*math.sqrt(p*(1-p)/n + z**2/(4*n**2))/(1 + z**2/n)
+    return center - half, center + half
+
+
+def mean_interval(values, z):
+    if len(values) < 2:
+        return -math.inf, math.inf
+    mean = np.mean(values)
+    half = z*np.std(values, ddof=1)/math.sqrt(len(values))
+    return mean - half, mean + half
+
+
+def baseline_score(experiment, filename):
+    with open(filename, 'r') as f:
+        return float(np.mean([sample_score(experiment, json.loads(line)) for line in f if line.strip()]))
+
+
+class SequentialEstimate:
+    """Running score of an evaluation with a confidence interval and a stopping rule."""
+
+    def __init__(self, experiment, confidence=0.95, target_width=None, baseline=None, min_samples=30):
+        if target_width is None and baseline is None:
+            raise ValueError("sequential evaluation needs a target_width or a baseline to stop on")
+        self.experiment = experiment
+        self.z = NormalDist().inv_cdf(0.5 + confidence/2)
+        self.confidence = confidence
+        self.target_width = target_width
+        self.baseline = baseline
+        self.min_samples = min_samples
+        self.scores = []
+
+    def add(self, res_dic):
+        self.scores.append(sample_score(self.experiment, res_dic))
+
+    def estimate(self):
+        return float(np.mean(self.scores)) if self.scores else None
+
+    def interval(self):
+        if self.experiment == "minimum_free_energy":
+            low, high = mean_interval(self.scores, self.z)
+            return max(low, 0.0), high  # absolute errors are never negative
+        return wilson_interval(sum(self.scores), len(self.scores), self.z)
+
+    def stop_reason(self):
+        """Return why evaluation can stop now, or None to keep going."""
+        if len(self.scores) < self.min_samples:
+            return None
+        low, high = self.interval()
+        if self.baseline is not None and (low > self.baseline or high < self.baseline):
+            lower_is_better = self.experiment == "minimum_free_energy"
+            better = (high < self.baseline) if lower_is_better else (low > self.baseline)
+            return "better than baseline" if better else "worse than baseline"
+        if self.target_width is not None and high - low <= self.target_width:
+            return "interval width reached"
+        return None
+
+
+def sample_runner(experiment, condition, max_tries, retry_delay, timeout_duration, modelid, coe_args, n_candidates, nupack_pool, nupack_cache):
+    """Return a coroutine function evaluating one validation sample with the per-sample functions of performance_test."""
+    if experiment == "reverse_complement":
+        return lambda sample: pt.reverse_complement_sample(sample,condition,max_tries,retry_delay,timeout_duration,modelid,n_candidates=n_candidates)
+    elif experiment == "secondary_structure":
+        return lambda sample: pt.secondary_structure_sample(sample,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=coe_args,n_candidates=n_candidates)
+    elif experiment == "minimum_free_energy":
+        return lambda sample: pt.mfe_sample(sample,condition,max_tries,retry_delay,timeout_duration,modelid,coe_args=coe_args,n_candidates=n_candidates)
+    elif experiment == "sequence_design":
+        return lambda sample: pt.sequence_sample(sample,condition,max_tries,retry_delay,timeout_duration,modelid,nupack_pool,nupack_cache,coe_args=coe_args,n_candidates=n_candidates)
+
+
+async def run_until_stopped(run_sample, val_set, order, concurrency, estimate, on_result):
+    """Evaluate samples in the given order until estimate says to stop; samples still in flight are cancelled.
+
+    Results enter the estimate strictly in the order of `order`: a sample that finishes early waits
+    until every sample before it is done, so the fast (usually easy) samples are not over-represented
+    when evaluation stops. Returns the telemetry of the samples in the estimate, and of the cancelled
+    ones together with those that finished past the point where evaluation stopped.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    stop = asyncio.Event()
+    done = {}  # position in order -> (telemetry, result) of samples waiting for an earlier one
+    finished = []
+    cancelled = []
+    next_position = 0
+    with tqdm(total=len(order), leave=False) as pbar:
+        async def run_one(position, indx):
+            nonlocal next_position
+            async with semaphore:
+                if stop.is_set():
+                    return
+                record = telemetry.start_sample()
+                try:
+                    res_dic = await run_sample(val_set[indx])
+                except asyncio.CancelledError:
+                    cancelled.append(record)
+                    raise
+            done[position] = (record, res_dic)
+            while next_position in done and not stop.is_set():
+                record, res_dic = done.pop(next_position)
+                finished.append(record)
+                estimate.add(res_dic)
+                on_result(order[next_position], res_dic)
+                pbar.update(1)
+                next_position += 1
+                if estimate.stop_reason() is not None:
+                    stop.set()
+
+        tasks = [asyncio.create_task(run_one(position, indx)) for position, indx in enumerate(order)]
+        all_done = asyncio.create_task(asyncio.wait(tasks))
+        stopped = asyncio.create_task(stop.wait())
+        await asyncio.wait([all_done, stopped], return_when=asyncio.FIRST_COMPLETED)
+        for task in tasks + [all_done, stopped]:
+            task.cancel()
+        await asyncio.gather(*tasks, all_done, stopped, return_exceptions=True)
+    cancelled += [record for record, _ in done.values()]
+    return finished, cancelled
+
+
+def sequential_filename(experiment, condition, max_tries, train_size):
+    return pt.results_filename(experiment, condition, max_tries, train_size)[:-len(".json")] + "_sequential.json"
+
+
+def analyze_model_sequential(experiment, condition, train_size, max_tries, modelid, coe_args=None, concurrency=1, n_candidates=1,
+                             target_width=None, baseline=None, confidence=0.95, min_samples=30, seed=23, verify_workers=None):
+    """Evaluate a model on a random subset of the validation set that is just large enough to decide.
+
+    baseline is a results file to compare against; "{train_size}" in its name is filled in, so one
+    pattern can name the baseline of every model of a learning curve. Results are written in the
+    random evaluation order, with their validation-set index, to the results file name ending in
+    "_sequential.json", so they are never mistaken for a full run.
+    """
+    retry_delay = 5  # Delay in seconds between retries
+    timeout_duration = 180  # Timeout in seconds for each API call
+
+    val_set = pt.load_validation_set(experiment)
+    baseline_value = None
+    if baseline is not None:
+        baseline = baseline.format(train_size=train_size)
+        baseline_value = baseline_score(experiment, baseline)
+    estimate = SequentialEstimate(experiment, confidence=confidence, target_width=target_width, baseline=baseline_value, min_samples=min_samples)
+    order = np.random.default_rng(seed).permutation(len(val_set)).tolist()
+
+    nupack_pool = nupack_cache = None
+    if experiment == "sequence_design":
+        nupack_pool = analysis_pool(verify_workers or os.cpu_count(), material='DNA', celsius=20)
+        nupack_cache = ComplexAnalysisCache(NUPACK_CACHE_PATH, material='DNA', celsius=20)
+    run_sample = sample_runner(experiment, condition, max_tries, retry_delay, timeout_duration, modelid, coe_args, n_candidates, nupack_pool, nupack_cache)
+
+    out_filename = sequential_filename(experiment, condition, max_tries, train_size)
+    with open(out_filename, 'w') as f:
+        def write(indx, res_dic):
+            f.write(json.dumps({**res_dic, "val_index": indx}) + '\n')
+            f.flush()
+        try:
+            finished, cancelled = pt.run_async(run_until_stopped(run_sample, val_set, order, concurrency, estimate, write))
+        finally:
+            if nupack_pool is not None:
+                nupack_pool.shutdown()
+                nupack_cache.close()
+
+    calls = sum(record.summary(0)["calls"] for record in finished)
+    wasted_calls = sum(record.summary(0)["calls"] for record in cancelled)
+    samples_saved = len(val_set) - len(finished)
+    calls_per_sample = calls/len(finished) if finished else 0.0
+    low, high = estimate.interval()
+    report = {"experiment": experiment, "condition": condition, "train_size": train_size,
+              "stop_reason": estimate.stop_reason() or "validation set exhausted",
+              "samples": len(finished), "samples_saved": samples_saved,
+              "calls": calls + wasted_calls, "calls_in_cancelled_samples": wasted_calls,
+              "estimated_calls_saved": round(calls_per_sample*samples_saved - wasted_calls),
+              "estimate": estimate.estimate(), "interval": [float(low), float(high)], "confidence": confidence,
+              "baseline": baseline, "baseline_value": baseline_value}
+    metric = "mean absolute error (kcal/mol)" if experiment == "minimum_free_energy" else "accuracy"
+    print(f"{experiment} {condition} train size {train_size}: stopped after {len(finished)}/{len(val_set)} samples ({report['stop_reason']})")
+    print(f"    {metric} = {report['estimate']:.3g}, {confidence*100:.3g}% interval [{low:.3g}, {high:.3g}]"
+          + (f", baseline {baseline_value:.3g}" if baseline_value is not None else ""))
+    print(f"    {report['calls']} API calls made, about {report['estimated_calls_saved']} saved; {samples_saved} samples not evaluated")
+    return report
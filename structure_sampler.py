@@ -0,0 +1,143 @@
+import sys
+import random
+from math import comb
+
+# Draws unique target structures for sequence design without rejecting duplicates. A target is a
+# fully paired duplex with num_mismatches unpaired positions on the first strand (mirrored on the
+# second), so the structures of a class (seq_length, num_mismatches) are the comb(seq_length,
+# num_mismatches) sets of mismatch positions. Each set has a rank in the combinatorial number
+# system, and every class keeps a sparse Fisher-Yates shuffle of its ranks: drawing swaps the
+# chosen rank with the last one still in the pool, so each draw is O(1) and never repeats.
+#
+# Designs are tracked per structure and per class. A target whose design misses its MFE structure
+# goes back into the pool until it has failed max_failures times, and a class whose designs keep
+# failing (below min_success_rate after min_attempts) is not drawn from any more.
+
+
+def rank_positions(positions):
+    """Rank of a set of positions among all sets of the same size (colexicographic order)."""
+    return sum(comb(pos, indx) for indx, pos in enumerate(sorted(positions), start=1))
+
+
+def unrank_positions(rank, seq_length, num_mismatches):
+    """The set of num_mismatches positions in range(seq_length) with the given rank, in decreasing order."""
+    positions = []
+    pos = seq_length - 1
+    for indx in range(num_mismatches, 0, -1):
+        while comb(pos, indx) > rank:
+            pos -= 1
+        positions.append(pos)
+        rank -= comb(pos, indx)
+        pos -= 1
+    return positions
+
+
+def mismatch_structure(seq_length, positions):
+    """The dot-paren-plus target with the given unpaired positions, as generate_secondary_structure builds it."""
+    start_strand = ['(']*seq_length
+    for pos in positions:
+        start_strand[pos] = '.'
+    start = ''.join(start_strand)
+    return start + '+' + start[::-1].replace('(', ')')
+
+
+def rank_structure(dotpar):
+    """(seq_length, num_mismatches, rank) of a target structure."""
+    start = dotpar[:dotpar.index('+')]
+    positions = [pos for pos, char in enumerate(start) if char == '.']
+    return len(start), len(positions), rank_positions(positions)
+
+
+class StructureClass:
+    """The targets of one (seq_length, num_mismatches), drawn without replacement."""
+
+    def __init__(self, seq_length, num_mismatches):
+        self.seq_length = seq_length
+        self.num_mismatches = num_mismatches
+        self.size = comb(seq_length, num_mismatches)
+        self.remaining = self.size
+        self.swaps = {}  # pool position -> rank, only where the shuffle moved something
+        self.failures = {}  # rank -> failed designs of targets that may be retried
+        self.attempts = 0
+        self.successes = 0
+
+    def draw(self, rng):
+        indx = rng.randrange(self.remaining)
+        last = self.remaining - 1
+        rank = self.swaps.get(indx, indx)
+        if indx != last:
+            self.swaps[indx] = self.swaps.pop(last, last)
+        else:
+            self.swaps.pop(last, None)
+        self.remaining -= 1
+        return rank
+
+    def put_back(self, rank):
+        if rank != self.remaining:
+            self.swaps[self.remaining] = rank
+        self.remaining += 1
+
+
+class StructureSampler:
+    """Unique random targets with the length and mismatch distribution of generate_training_structures.
+
+    rng is anything with randint and randrange; the random module itself by default, so random.seed
+    makes the draws reproducible.
+    """
+
+    def __init__(self, min_length=10, max_length=25, mismatch_fraction=0.3, rng=random,
+                 max_failures=2, min_attempts=50, min_success_rate=0.05):
+        self.min_length = min_length
+        self.max_length = max_length
+        self.mismatch_fraction = mismatch_fraction
+        self.rng = rng
+        self.max_failures = max_failures
+        self.min_attempts = min_attempts
+        self.min_success_rate = min_success_rate
+        self.classes = {(seq_length, num_mismatches): StructureClass(seq_length, num_mismatches)
+                        for seq_length in range(min_length, max_length + 1)
+                        for num_mismatches in range(1, max(1, round(seq_length*mismatch_fraction)) + 1)}
+
+    def retired(self, cls):
+        return cls.attempts >= self.min_attempts and cls.successes < self.min_success_rate*cls.attempts
+
+    def available(self, cls):
+        return cls.remaining > 0 and not self.retired(cls)
+
+    def draw(self):
+        """A target structure not drawn before, or put back after a failed design."""
+        while True:
+            seq_length = self.rng.randint(self.min_length, self.max_length)
+            num_mismatches = max(1, self.rng.randint(0, round(seq_length*self.mismatch_fraction)))
+            cls = self.classes[(seq_length, num_mismatches)]
+            if self.available(cls):
+                positions = unrank_positions(cls.draw(self.rng), seq_length, num_mismatches)
+                return mismatch_structure(seq_length, positions)
+            # only small classes run out; the class is drawn again like a duplicate was before
+            if not any(self.available(other) for other in self.classes.values()):
+                raise ValueError("every structure class is exhausted or retired")
+
+    def record(self, dotpar, success):
+        """Record whether the design of a drawn target folded into it; failed targets go back into the pool for a retry."""
+        seq_length, num_mismatches, rank = rank_structure(dotpar)
+        cls = self.classes[(seq_length, num_mismatches)]
+        cls.attempts += 1
+        if success:
+            cls.successes += 1
+            cls.failures.pop(rank, None)
+            return
+        failures = cls.failures.get(rank, 0) + 1
+        if failures < self.max_failures:
+            cls.failures[rank] = failures
+            cls.put_back(rank)
+        else:
+            cls.failures.pop(rank, None)
+
+    def report(self, file=sys.stdout):
+        attempts = sum(cls.attempts for cls in self.classes.values())
+        successes = sum(cls.successes for cls in self.classes.values())
+        print(f"{successes} of {attempts} designs folded into their target", file=file)
+        for (seq_length, num_mismatches), cls in self.classes.items():
+            if self.retired(cls):
+                print(f"stopped drawing length {seq_length} with {num_mismatches} mismatches: "
+                      f"{cls.successes} of {cls.attempts} designs succeeded", file=file)
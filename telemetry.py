@@ -0,0 +1,97 @@
+import json
+import time
+import contextvars
+
+# Per-sample accounting of API calls. Each sample being evaluated gets a SampleTelemetry that is
+# made current for the asyncio task working on it, so call_openai_api (and the NUPACK check) can
+# attribute every call to the sample and stage that made it without the record being passed
+# through the sample coroutines.
+current_sample = contextvars.ContextVar("current_sample", default=None)
+# TelemetryLog of the run the current task belongs to; several runs may share one event loop
+current_log = contextvars.ContextVar("current_log", default=None)
+
+
+def new_stage():
+    return {"calls": 0, "retries": 0, "timeouts": 0, "cache_hits": 0, "seconds": 0.0,
+            "prompt_tokens": 0, "completion_tokens": 0, "latencies": []}
+
+
+class SampleTelemetry:
+
+    def __init__(self):
+        self.start = None  # set when work on the sample begins
+        self.stages = {}
+        self.retry_pending = {}  # stage -> the last call timed out, so the next one is a retry
+
+    def record_call(self, stage, seconds, response, message, attempt=0, cached=False):
+        entry = self.stages.setdefault(stage, new_stage())
+        entry["calls"] += 1
+        if attempt > 0 or self.retry_pending.get(stage):
+            entry["retries"] += 1
+        entry["seconds"] += seconds
+        entry["latencies"].append(round(seconds, 4))
+        self.retry_pending[stage] = response is None
+        if response is None:
+            entry["timeouts"] += 1
+        elif cached:
+            entry["cache_hits"] += 1
+        elif response.usage is not None:
+            entry["prompt_tokens"] += response.usage.prompt_tokens
+            entry["completion_tokens"] += response.usage.completion_tokens
+        else:
+            # streamed responses carry no usage, so both counts are estimated from the text
+            entry["prompt_tokens"] += sum(len(part["content"]) for part in message)//4
+            entry["completion_tokens"] += sum(len(str(choice.message.content)) for choice in response.choices)//4
+
+    def record_time(self, stage, seconds):
+        entry = self.stages.setdefault(stage, new_stage())
+        entry["seconds"] += seconds
+        entry["latencies"].append(round(seconds, 4))
+
+    def summary(self, index):
+        totals = {key: sum(entry[key] for entry in self.stages.values())
+                  for key in ("calls", "retries", "timeouts", "cache_hits", "prompt_tokens", "completion_tokens")}
+        stages = {name: {**entry, "seconds": round(entry["seconds"], 4)} for name, entry in self.stages.items()}
+        return {"index": index, "seconds": round(time.monotonic() - self.start, 4), **totals, "stages": stages}
+
+
+def start_sample(record=None):
+    """Make record (a new one by default) the current sample of this task and return it."""
+    if record is None:
+        record = SampleTelemetry()
+    if record.start is None:
+        record.start = time.monotonic()
+    current_sample.set(record)
+    return record
+
+
+def record_call(stage, seconds, response, message, attempt=0, cached=False):
+    record = current_sample.get()
+    if record is not None:
+        record.record_call(stage, seconds, response, message, attempt, cached)
+
+
+def record_time(stage, seconds):
+    record = current_sample.get()
+    if record is not None:
+        record.record_time(stage, seconds)
+
+
+def telemetry_filename(results_filename):
+    """Sidecar file next to a results file, e.g. test_results/x_test_size_500_telemetry.jsonl for x_test_size_500.json."""
+    return results_filename[:-len(".json")] + "_telemetry.jsonl"
+
+
+class TelemetryLog:
+    """Appends one summary line per finished sample; index is the sample's line in the results file."""
+
+    def __init__(self, filename, offset=0):
+        self.f = open(filename, 'a' if offset else 'w')
+        self.offset = offset
+
+    def write(self, indx, record):
+        self.f.write(json.dumps(record.summary(self.offset + indx)) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
@@ -0,0 +1,106 @@
+import os
+import re
+import json
+import numpy as np
+
+EXPERIMENTS = ["reverse_complement", "secondary_structure", "minimum_free_energy", "sequence_design"]
+RETRY_BINS = [0, 1, 2, 3, 4, 5]  # the last bin counts 5 or more retries
+
+
+def is_correct(experiment, entry):
+    if experiment == "reverse_complement":
+        return entry["model"] == entry["rev2"]
+    elif experiment == "secondary_structure":
+        return entry["model_structure"] == entry["structure"]
+    elif experiment == "minimum_free_energy":
+        # MFEs are given to 0.1 kcal/mol, so a correct answer is an exact match at that precision
+        return entry["model_MFE"] != "2" and abs(float(entry["model_MFE"]) - float(entry["MFE"])) < 0.05
+    elif experiment == "sequence_design":
+        return entry["model_structure"] == entry["structure"]
+
+
+def parse_run_name(filename):
+    """Return (experiment, condition, train size) for a telemetry file name."""
+    name = os.path.basename(filename)[:-len("_telemetry.jsonl")]
+    experiment = next(exp for exp in EXPERIMENTS if name.startswith(exp))
+    match = re.search(r'_test_size_(\d+)$', name)
+    condition = re.sub(r'_?max_tries_\d+_test_size_\d+$', '', name[len(experiment)+1:])
+    return experiment, condition or None, int(match.group(1))
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 3), "p95": round(float(p95), 3), "p99": round(float(p99), 3)}
+
+
+def summarize_run(filename):
+    """Summarize one telemetry file together with the results file it sits next to."""
+    experiment, condition, train_size = parse_run_name(filename)
+    with open(filename, 'r') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    results_file = filename[:-len("_telemetry.jsonl")] + ".json"
+    correct = {}
+    if os.path.exists(results_file):
+        with open(results_file, 'r') as f:
+            correct = {indx: is_correct(experiment, json.loads(line)) for indx, line in enumerate(f) if line.strip()}
+
+    n_correct = sum(correct.get(record["index"], False) for record in records)
+    tokens = sum(record["prompt_tokens"] + record["completion_tokens"] for record in records)
+    retry_counts = np.bincount(np.minimum([record["retries"] for record in records], RETRY_BINS[-1]), minlength=len(RETRY_BINS))
+    stages = {}
+    for record in records:
+        for name, entry in record["stages"].items():
+            stage = stages.setdefault(name, {"calls": 0, "retries": 0, "timeouts": 0, "seconds": 0.0, "tokens": 0, "latencies": []})
+            stage["calls"] += entry["calls"]
+            stage["retries"] += entry["retries"]
+            stage["timeouts"] += entry["timeouts"]
+            stage["seconds"] += entry["seconds"]
+            stage["tokens"] += entry["prompt_tokens"] + entry["completion_tokens"]
+            stage["latencies"].extend(entry["latencies"])
+    total_seconds = sum(stage["seconds"] for stage in stages.values())
+    for stage in stages.values():
+        stage["latency"] = percentiles(stage.pop("latencies"))
+        stage["share_of_seconds"] = round(stage["seconds"]/total_seconds, 3) if total_seconds else 0.0
+        stage["share_of_tokens"] = round(stage["tokens"]/tokens, 3) if tokens else 0.0
+        stage["seconds"] = round(stage["seconds"], 1)
+
+    return {"experiment": experiment, "condition": condition, "train_size": train_size,
+            "samples": len(records),
+            "accuracy": n_correct/len(records) if records else None,
+            "calls": sum(record["calls"] for record in records),
+            "timeouts": sum(record["timeouts"] for record in records),
+            "call_latency": percentiles([latency for record in records for entry in record["stages"].values() for latency in entry["latencies"]]),
+            "sample_seconds": percentiles([record["seconds"] for record in records]),
+            "tokens": tokens,
+            "tokens_per_correct": round(tokens/n_correct, 1) if n_correct else None,
+            "retry_histogram": {(f"{bin}+" if bin == RETRY_BINS[-1] else str(bin)): int(count) for bin, count in zip(RETRY_BINS, retry_counts)},
+            "stages": stages}
+
+
+def telemetry_report(directory="test_results"):
+    # shard telemetry is reported once merge_shards.py has combined it
+    files = sorted(fn for fn in os.listdir(directory) if fn.endswith("_telemetry.jsonl") and "_shard_" not in fn)
+    summaries = [summarize_run(f"{directory}/{fn}") for fn in files]
+    summaries.sort(key=lambda summary: (summary["experiment"], str(summary["condition"]), summary["train_size"]))
+    experiment = None
+    for summary in summaries:
+        if summary["experiment"] != experiment:
+            experiment = summary["experiment"]
+            print("----")
+            print(f"{experiment}")
+        accuracy = f"{summary['accuracy']*100:.3g}%" if summary["accuracy"] is not None else "n/a"
+        print(f"{summary['condition']} train size {summary['train_size']}: {summary['samples']} samples, accuracy={accuracy}, "
+              f"calls={summary['calls']}, timeouts={summary['timeouts']}, tokens per correct={summary['tokens_per_correct']}")
+        print(f"    call latency (s) {summary['call_latency']}, sample time (s) {summary['sample_seconds']}")
+        print(f"    retries per sample {summary['retry_histogram']}")
+        for name, stage in summary["stages"].items():
+            print(f"    {name}: calls={stage['calls']}, retries={stage['retries']}, timeouts={stage['timeouts']}, "
+                  f"seconds={stage['seconds']} ({stage['share_of_seconds']*100:.3g}%), tokens={stage['tokens']} ({stage['share_of_tokens']*100:.3g}%), "
+                  f"latency (s) {stage['latency']}")
+    return summaries
+
+
+if __name__ == '__main__':
+    telemetry_report()
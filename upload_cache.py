@@ -0,0 +1,78 @@
+import os
+import json
+import hashlib
+import openai
+
+# Uploads of training files, deduplicated by content. The manifest maps the sha256 of every file
+# uploaded before to its OpenAI file id; a file whose exact contents were uploaded already is not
+# sent again, as long as the remote file still exists and was processed without error.
+MANIFEST_PATH = "upload_manifest.json"
+
+
+def file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class UploadManifest:
+
+    def __init__(self, filename=MANIFEST_PATH):
+        self.filename = filename
+        self.entries = {}
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                self.entries = json.load(f)
+        self.hits = 0
+        self.uploads = 0
+
+    def key(self, sha256, purpose):
+        return f"{purpose}:{sha256}"
+
+    def lookup(self, sha256, purpose):
+        entry = self.entries.get(self.key(sha256, purpose))
+        return entry["file_id"] if entry is not None else None
+
+    def add(self, sha256, purpose, file_id, filename):
+        self.entries[self.key(sha256, purpose)] = {"file_id": file_id, "filename": filename, "bytes": os.path.getsize(filename)}
+        self.save()
+
+    def remove(self, sha256, purpose):
+        self.entries.pop(self.key(sha256, purpose), None)
+        self.save()
+
+    def save(self):
+        with open(self.filename + ".tmp", 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def stats(self):
+        return {"hits": self.hits, "uploads": self.uploads, "files": len(self.entries)}
+
+
+def usable(file_handle):
+    return file_handle.status != "error" and not getattr(file_handle, "deleted", False)
+
+
+async def upload_file_async(client, filename, purpose="fine-tune", manifest=None):
+    """Return the id of an uploaded file with the contents of filename, uploading it with the AsyncOpenAI client only if needed."""
+    if manifest is None:
+        manifest = UploadManifest()
+    sha256 = file_sha256(filename)
+    file_id = manifest.lookup(sha256, purpose)
+    if file_id is not None:
+        try:
+            if usable(await client.files.retrieve(file_id)):
+                manifest.hits += 1
+                print(f"{filename} was uploaded before as {file_id}")
+                return file_id
+        except openai.NotFoundError:
+            pass
+        manifest.remove(sha256, purpose)
+    with open(filename, 'rb') as f:
+        file_id = (await client.files.create(file=f, purpose=purpose)).id
+    manifest.uploads += 1
+    manifest.add(sha256, purpose, file_id, filename)
+    return file_id